@@ -1,8 +1,33 @@
-from scipy.signal import welch, filtfilt, butter, lfilter
-from numpy import array, mean, logical_and, trapz
+from collections import deque
+from functools import lru_cache
+from numpy import asarray, arange, concatenate, cos, empty, exp, mean, logical_and, outer, pi, round as np_round, \
+    stack, trapz, where, zeros, complex128, float64
+from numpy.fft import rfft, rfftfreq
+from numpy.lib.stride_tricks import sliding_window_view
+
+# scipy.signal takes about a second to import and only the filters / Welch below need it, so it is imported
+# where it is used: the dashboard process never loads it, acquisition and the classifier on first use.
+
+# EEG band edges (Hz) shared by training features and live displays
+EEG_BANDS = (("Delta", 2, 4), ("Theta", 4, 8), ("Alpha", 8, 14), ("Beta", 14, 30), ("Gamma", 30, 100))
+
+# extraction parameters that change what a feature vector means; they are saved with every model so the online
+# classifier computes the features the model was trained on
+FEATURE_KEYS = ('window', 'welch_tw', 'sr', 'streaming')
+# models saved without them were trained on per-window features filtered from zero state
+LEGACY_FEATURES = dict(window=1, welch_tw=0.8, sr=1000, streaming=False)
+
+# largest relative deviation of SlidingDFT / StreamingBandPowers from the batch estimates they track
+SDFT_TOLERANCE = 1e-9
+
+
+def feature_definition(params):
+    # the FEATURE_KEYS of a set of extraction parameters, see data_extraction.FEATURE_PARAMS
+    return {key: params[key] for key in FEATURE_KEYS}
 
 
 def baseline_shift(signal_uv: list, t_start, t_end, sr=1000, ):
+    # signal_uv is 1-D or (channels, samples), every channel is shifted by its own mean
     # Time window
     # t_start: lower limit of time window (s)
     sample_start = int(t_start * sr)
@@ -11,13 +36,13 @@ def baseline_shift(signal_uv: list, t_start, t_end, sr=1000, ):
 
     # Cutoff frequencies: f1, f2
     # Baseline shift of window
-    signal_shift_window = array(signal_uv[sample_start:sample_end]) - mean(
-        array(signal_uv[sample_start:sample_end]))
+    window = asarray(signal_uv)[..., sample_start:sample_end]
+    signal_shift_window = window - mean(window, axis=-1, keepdims=True)
     return signal_shift_window
 
 
 def filtered(signal_uv: list, f1=3, f2=30, sr=1000):
-    # Digital Bandpass filtering with cutoff frequencies of f1=3 and f2=30 Hz using bandpass
+    # Digital Bandpass filtering with cutoff frequencies of f1=3 and f2=30 Hz using bandpass (along the last axis)
     filtered_signal = bandpass(signal_uv, f1, f2, order=2, fs=sr)
 
     return filtered_signal
@@ -25,10 +50,11 @@ def filtered(signal_uv: list, f1=3, f2=30, sr=1000):
 
 def show_psd(signal_uv: list, welch_tw=4, sr=1000):
     # Time Windows for Welchs method
-    win = welch_tw * sr  # welch_tw seconds time windows.
+    win = int(welch_tw * sr)  # welch_tw seconds time windows.
 
-    # FFT with time windows using scipy.signal.welch
-    freq_axis, power_spect = welch(signal_uv, sr, nperseg=win)
+    # FFT with time windows using scipy.signal.welch, one spectrum per channel for (channels, samples) input
+    from scipy.signal import welch
+    freq_axis, power_spect = welch(signal_uv, sr, nperseg=win, axis=-1)
     return freq_axis, power_spect
 
 
@@ -42,9 +68,9 @@ def clc_power(freq_axis, power_spect, freq_low=8, freq_high=12):
     except IndexError:
         freq_res = 1
 
-    # Compute the Absolute Power with numpy.trapz:
-    alpha_power = trapz(power_spect[idx_alpha], dx=freq_res)
-    alpha_power = round(alpha_power, 2)
+    # Compute the Absolute Power with numpy.trapz (per channel for 2-D spectra):
+    alpha_power = trapz(asarray(power_spect)[..., idx_alpha], dx=freq_res, axis=-1)
+    alpha_power = np_round(alpha_power, 2)
     return alpha_power
 
 
@@ -91,9 +117,338 @@ def bandpass(s, f1, f2, order=2, fs=1000.0, use_filtfilt=False):
             filtered signal
 
         """
-    [b, a] = butter(Wn=[f1 * 2 / fs, f2 * 2 / fs], btype='bandpass', N=order, output='ba')
+    from scipy.signal import filtfilt, lfilter
+
+    [b, a] = butter_bandpass(f1, f2, order=order, fs=fs, output='ba')
 
     if use_filtfilt:
         return filtfilt(b, a, s)
 
     return lfilter(b, a, s)
+
+
+@lru_cache(maxsize=64)
+def butter_bandpass(f1, f2, order=2, fs=1000.0, output='ba'):
+    # Butterworth design is memoized, the (f1, f2, order, fs) tuples come from a small fixed set of bands
+    # callers must not modify the returned arrays
+    from scipy.signal import butter
+    return butter(Wn=[f1 * 2 / fs, f2 * 2 / fs], btype='bandpass', N=order, output=output)
+
+
+class FilterBank(object):
+    """
+    Streaming band-pass filters, one per band, built from the cached Butterworth designs.
+
+    Each band keeps its own filter state between calls, so a continuous stream can be pushed through chunk by
+    chunk and every sample is filtered exactly once. Chunks may be 1-D or (channels, samples). The order-2
+    designs are applied in transfer-function form like bandpass(): lfilter costs a fraction of sosfilt's
+    per-call overhead, which dominates for the 50-sample chunks of a live hop.
+    """
+
+    def __init__(self, bands=EEG_BANDS, order=2, sr=1000):
+        self.bands = bands
+        self.ba = [butter_bandpass(f1, f2, order=order, fs=sr, output='ba') for _, f1, f2 in bands]
+        self.zi = None
+
+    def reset(self):
+        self.zi = None
+
+    def process(self, chunk):
+        # returns (len(bands), *chunk.shape) filtered samples
+        from scipy.signal import lfilter, lfilter_zi
+
+        chunk = asarray(chunk, dtype=float64)
+        if self.zi is None:
+            # start from the steady state of the first sample to avoid a start-up transient
+            first = chunk[..., :1]
+            self.zi = [lfilter_zi(b, a) * first for b, a in self.ba]
+        out = empty((len(self.ba),) + chunk.shape)
+        for j, (b, a) in enumerate(self.ba):
+            out[j], self.zi[j] = lfilter(b, a, chunk, axis=-1, zi=self.zi[j])
+        return out
+
+
+def filtered_band_powers(segments, bands=EEG_BANDS, sr=1000):
+    # segments: (len(bands), ..., nperseg) band-filtered samples; band j is integrated from the Hann
+    # periodogram of row j only, like clc_power. Returns (..., len(bands)).
+    from scipy.signal import welch
+
+    freq_axis, power_spect = welch(segments, sr, nperseg=segments.shape[-1], axis=-1)
+    freq_res = freq_axis[1] - freq_axis[0]
+    return stack([trapz(power_spect[j][..., logical_and(freq_axis >= f1, freq_axis <= f2)], dx=freq_res, axis=-1)
+                  for j, (_, f1, f2) in enumerate(bands)], axis=-1)
+
+
+class RunningWelch(object):
+    """
+    Incremental Welch estimate over the most recent n_segments segments of a stream.
+
+    Segments are welch_tw seconds long with 50 % overlap, Hann windowed, mean-detrended and density scaled
+    exactly like scipy.signal.welch, so power_spect() equals welch() over the span the segments cover. Each
+    update only computes the periodograms of the segments completed by the new samples and keeps a running
+    sum, instead of recomputing the whole window. Works on 1-D or (channels, samples) chunks.
+    """
+
+    def __init__(self, welch_tw=0.8, sr=1000, n_segments=4, bands=EEG_BANDS):
+        self.sr = sr
+        self.nperseg = int(welch_tw * sr)
+        self.step = self.nperseg // 2
+        self.window = 0.5 - 0.5 * cos(2 * pi * arange(self.nperseg) / self.nperseg)  # get_window('hann')
+        self.scale = 1.0 / (sr * (self.window * self.window).sum())
+        self.freq_axis = rfftfreq(self.nperseg, 1 / sr)
+        self.bands = bands
+        self.band_masks = [logical_and(self.freq_axis >= f1, self.freq_axis <= f2) for _, f1, f2 in bands]
+        self.segments = deque(maxlen=n_segments)
+        self.total = None
+        self.tail = None  # samples not yet covered by a complete segment, plus the overlap
+
+    def update(self, chunk):
+        chunk = asarray(chunk, dtype=float64)
+        self.tail = chunk if self.tail is None else concatenate((self.tail, chunk), axis=-1)
+        while self.tail.shape[-1] >= self.nperseg:
+            segment = self.tail[..., :self.nperseg]
+            segment = (segment - mean(segment, axis=-1, keepdims=True)) * self.window
+            spectrum = abs(rfft(segment, axis=-1)) ** 2 * self.scale
+            spectrum[..., 1:] *= 2  # one-sided
+            if self.nperseg % 2 == 0:
+                spectrum[..., -1] /= 2  # Nyquist bin is not doubled
+            if len(self.segments) == self.segments.maxlen:
+                self.total = self.total - self.segments[0]
+            self.segments.append(spectrum)
+            self.total = spectrum.copy() if self.total is None or len(self.segments) == 1 else self.total + spectrum
+            self.tail = self.tail[..., self.step:]
+
+    def power_spect(self):
+        if not self.segments:
+            return None
+        return self.total / len(self.segments)
+
+    def band_powers(self):
+        # (..., len(bands)) absolute band powers integrated like clc_power
+        power_spect = self.power_spect()
+        if power_spect is None:
+            return None
+        freq_res = self.freq_axis[1] - self.freq_axis[0]
+        return stack([trapz(power_spect[..., mask], dx=freq_res, axis=-1) for mask in self.band_masks], axis=-1)
+
+
+class SlidingDFT(object):
+    """
+    Band powers of the newest window, updated sample by sample with a sliding DFT.
+
+    Only the DFT bins inside the bands (plus one neighbour on each side) are tracked. Every new sample
+    rotates them in O(bins) with X_k <- e^(2j pi k / N) (X_k - x_oldest + x_new); a block of samples is
+    applied as one (samples x bins) product. The cost per hop therefore depends on the hop and the number
+    of bins inside the bands, not on the window length. The periodic Hann window is applied in the
+    frequency domain (0.5 X_k - 0.25 X_k-1 - 0.25 X_k+1), the segment mean through a running sum, so
+    band_powers() equals clc_power(*show_psd(last window, welch_tw=window)) without rounding. The bins are
+    recomputed from the stored window every resync windows to drop the accumulated rounding error.
+
+    Relative deviation from the batch estimate stays below SDFT_TOLERANCE. StreamingBandPowers runs one
+    per band on the FilterBank output, which gives the live classifier the training features of
+    streaming_band_power_matrix. Works on 1-D or (channels, samples) chunks.
+    """
+
+    def __init__(self, window=0.8, sr=1000, bands=EEG_BANDS, resync=8):
+        self.sr = sr
+        self.n = int(window * sr)
+        self.bands = bands
+        freq_axis = rfftfreq(self.n, 1 / sr)
+        masks = [logical_and(freq_axis >= f1, freq_axis <= f2) for _, f1, f2 in bands]
+        used = [k for mask in masks for k in mask.nonzero()[0]]
+        # tracked bins lo..hi cover every band bin and its Hann neighbours
+        self.lo, self.hi = max(min(used) - 1, 0), min(max(used) + 1, self.n // 2)
+        self.bins = arange(self.lo, self.hi + 1)
+        self.band_bins = [mask.nonzero()[0] for mask in masks]
+        self.freq_res = freq_axis[1] - freq_axis[0]
+        hann = 0.5 - 0.5 * cos(2 * pi * arange(self.n) / self.n)
+        self.scale = 1.0 / (sr * (hann * hann).sum())
+        self.resync_every = resync * self.n
+        self.rotations = {}  # block length -> (bins,) block rotation and (samples, bins) twiddle factors
+        self.spectrum = None
+        self.history = None  # circular (..., n) copy of the window, oldest sample at self.oldest
+        self.oldest = 0
+        self.total = None
+        self.count = 0
+        self.since_resync = 0
+
+    def _rotation(self, m):
+        if m not in self.rotations:
+            # the spectrum turns m steps per block, sample i of the block m - i times by the time it is in
+            self.rotations[m] = (exp(2j * pi * self.bins * m / self.n),
+                                 exp(2j * pi * outer(arange(m, 0, -1), self.bins) / self.n))
+        return self.rotations[m]
+
+    def update(self, chunk):
+        chunk = asarray(chunk, dtype=float64)
+        if self.history is None:
+            self.history = zeros(chunk.shape[:-1] + (self.n,))
+            self.spectrum = zeros(chunk.shape[:-1] + (len(self.bins),), dtype=complex128)
+            self.total = zeros(chunk.shape[:-1])
+        for start in range(0, chunk.shape[-1], self.n):
+            block = chunk[..., start:start + self.n]
+            m = block.shape[-1]
+            slots = (self.oldest + arange(m)) % self.n
+            delta = block - self.history[..., slots]
+            block_rotation, twiddles = self._rotation(m)
+            self.spectrum = self.spectrum * block_rotation + delta @ twiddles
+            self.total = self.total + delta.sum(axis=-1)
+            self.history[..., slots] = block
+            self.oldest = (self.oldest + m) % self.n
+            self.count += m
+            self.since_resync += m
+        if self.since_resync >= self.resync_every:
+            self.resync()
+
+    def resync(self):
+        # exact bins of the stored window, ordered oldest first
+        window = concatenate((self.history[..., self.oldest:], self.history[..., :self.oldest]), axis=-1)
+        self.spectrum = rfft(window, axis=-1)[..., self.lo:self.hi + 1]
+        self.total = window.sum(axis=-1)
+        self.since_resync = 0
+
+    def power_spect(self):
+        # density-scaled one-sided Hann periodogram of the mean-removed window at self.bins, None until full
+        if self.count < self.n:
+            return None
+        spectrum = self.spectrum
+        # Hann in the frequency domain; bin -1 of a real signal is the conjugate of bin 1
+        lower = concatenate((spectrum[..., 1:2].conj(), spectrum[..., :-1]), axis=-1) if self.lo == 0 \
+            else concatenate((zeros(spectrum.shape[:-1] + (1,)), spectrum[..., :-1]), axis=-1)
+        upper = concatenate((spectrum[..., 1:], zeros(spectrum.shape[:-1] + (1,))), axis=-1)
+        windowed = 0.5 * spectrum - 0.25 * lower - 0.25 * upper
+        # detrend: the mean only leaks into bins 0 and +-1 of the Hann spectrum
+        mean_value = self.total / self.n
+        for k, leak in ((0, self.n / 2), (1, -self.n / 4)):
+            if self.lo <= k <= self.hi:
+                windowed[..., k - self.lo] -= mean_value * leak
+        power = abs(windowed) ** 2 * self.scale
+        one_sided = where((self.bins == 0) | (2 * self.bins == self.n), 1.0, 2.0)
+        return power * one_sided
+
+    def band_powers(self):
+        # (..., len(bands)) absolute band powers integrated like clc_power, None until the window is full
+        power_spect = self.power_spect()
+        if power_spect is None:
+            return None
+        return stack([trapz(power_spect[..., k - self.lo], dx=self.freq_res, axis=-1) for k in self.band_bins],
+                     axis=-1)
+
+
+class StreamingBandPowers(object):
+    """
+    Live band powers of a continuously band-pass filtered stream, see streaming_band_power_matrix.
+
+    Each new chunk goes through the FilterBank once, and each band's output updates a SlidingDFT that only
+    tracks the bins of that band, so a hop costs O(hop * band bins) whatever the window length: nothing is
+    re-filtered and no window is re-transformed. band_powers() equals the batch training features of
+    streaming_band_power_matrix to SDFT_TOLERANCE (see benchmark.py --check-features). Works on 1-D or
+    (channels, samples) chunks.
+    """
+
+    def __init__(self, welch_tw=0.8, sr=1000, bands=EEG_BANDS):
+        self.welch_tw = welch_tw
+        self.sr = sr
+        self.bands = bands
+        self.filters = FilterBank(bands, sr=sr)
+        self.trackers = None
+        self.reset()
+
+    def reset(self):
+        # also after a gap in the stream
+        self.filters.reset()
+        self.trackers = [SlidingDFT(window=self.welch_tw, sr=self.sr, bands=(band,)) for band in self.bands]
+
+    def update(self, chunk):
+        chunk = asarray(chunk, dtype=float64)
+        if chunk.shape[-1] == 0:
+            return
+        for tracker, filtered in zip(self.trackers, self.filters.process(chunk)):
+            tracker.update(filtered)
+
+    def band_powers(self):
+        # (..., len(bands)), None until welch_tw seconds have been filtered
+        powers = [tracker.band_powers() for tracker in self.trackers]
+        if powers[0] is None:
+            return None
+        return stack([power[..., 0] for power in powers], axis=-1)
+
+
+def sliding_windows(signal_uv, t_start=8, n_windows=500, window=1, hop=0.05, sr=1000):
+    # zero-copy view of overlapping windows, stepping by hop seconds from t_start:
+    # (n_windows, window * sr) for 1-D signals, (channels, n_windows, window * sr) for (channels, samples)
+    sample_start = int(round(t_start * sr))
+    win = int(round(window * sr))
+    step = int(round(hop * sr))
+    signal_uv = asarray(signal_uv, dtype=float64)[..., sample_start:]
+    if signal_uv.shape[-1] < win:
+        return empty(signal_uv.shape[:-1] + (0, win))
+    return sliding_window_view(signal_uv, win, axis=-1)[..., ::step, :][..., :n_windows, :]
+
+
+def band_power_matrix(windows, bands=EEG_BANDS, welch_tw=0.8, sr=1000):
+    """
+    Vectorized equivalent of baseline_shift -> filtered -> show_psd -> clc_power for every window and band.
+
+    windows: (..., samples) array, e.g. (n_windows, samples) or (channels, n_windows, samples) from sliding_windows
+    Returns a (..., len(bands)) array of absolute band powers rounded like clc_power, all channels and windows
+    being processed in the same vectorized calls.
+    """
+    from scipy.signal import welch
+
+    windows = asarray(windows, dtype=float64)
+    bs_data = windows - mean(windows, axis=-1, keepdims=True)
+
+    # one filter per band over all windows at once, then a single Welch call over the (bands, windows) stack
+    filtered_bands = stack([bandpass(bs_data, f1, f2, order=2, fs=sr) for _, f1, f2 in bands])
+    freq_axis, power_spect = welch(filtered_bands, sr, nperseg=int(welch_tw * sr), axis=-1)
+    try:
+        freq_res = freq_axis[1] - freq_axis[0]
+    except IndexError:
+        freq_res = 1
+
+    powers = empty(windows.shape[:-1] + (len(bands),))
+    for j, (_, freq_low, freq_high) in enumerate(bands):
+        idx_band = logical_and(freq_axis >= freq_low, freq_axis <= freq_high)
+        powers[..., j] = trapz(power_spect[j][..., idx_band], dx=freq_res, axis=-1)
+    return np_round(powers, 2)
+
+
+def streaming_band_power_matrix(signal_uv, t_start=8, n_windows=500, window=1, hop=0.05, welch_tw=0.8, sr=1000,
+                                bands=EEG_BANDS, batch_windows=500, settle=8.0):
+    """
+    Training features that match StreamingBandPowers, i.e. what the live classifier computes every hop.
+
+    The recording is band-pass filtered as one continuous stream and each window (stepped like sliding_windows)
+    is described by the band powers of its last welch_tw seconds. Filtering starts settle seconds before the
+    first of those segments, or at the start of the recording, so the filters have forgotten their initial
+    state, and runs batch_windows windows at a time so memory stays bounded on long sessions.
+    signal_uv: (samples,) or (channels, samples)
+    Returns (n_windows, len(bands)) or (channels, n_windows, len(bands)); values are not rounded.
+    """
+    signal_uv = asarray(signal_uv, dtype=float64)
+    sample_start = int(round(t_start * sr))
+    win = int(round(window * sr))
+    step = int(round(hop * sr))
+    nperseg = int(welch_tw * sr)
+    available = signal_uv.shape[-1] - sample_start
+    n = 0 if available < win else (available - win) // step + 1
+    n = n if n_windows is None else min(n, n_windows)
+    powers = empty(signal_uv.shape[:-1] + (n, len(bands)))
+    if n == 0:
+        return powers
+    ends = sample_start + win + step * arange(n)
+    filters = FilterBank(bands, sr=sr)
+    position = max(ends[0] - nperseg - int(settle * sr), 0)
+    carry = None
+    for i in range(0, n, batch_windows):
+        batch_ends = ends[i:i + batch_windows]
+        filtered = filters.process(signal_uv[..., position:batch_ends[-1]])
+        if carry is not None:
+            filtered = concatenate((carry, filtered), axis=-1)
+        first = batch_ends[-1] - filtered.shape[-1]  # sample index of filtered[..., 0]
+        segments = sliding_window_view(filtered, nperseg, axis=-1)[..., batch_ends - nperseg - first, :]
+        powers[..., i:i + len(batch_ends), :] = filtered_band_powers(segments, bands, sr)
+        carry = filtered[..., -nperseg:]
+        position = batch_ends[-1]
+    return powers
@@ -0,0 +1,70 @@
+// Live sample graph, band powers, prediction and shared status, pushed by the server over /stream (server-sent events).
+(function () {
+    function decode(b64, Type) {
+        var bytes = Uint8Array.from(atob(b64), function (c) { return c.charCodeAt(0); });
+        return new Type(bytes.buffer);
+    }
+
+    function graphDiv(id) {
+        var graph = document.getElementById(id);
+        return graph ? graph.querySelector('.js-plotly-plot') : null;
+    }
+
+    function drawBands(bands) {
+        var gd = graphDiv('psd-graph');
+        if (gd && window.Plotly) {
+            window.Plotly.restyle(gd, {y: [bands]}, [0]);
+        }
+    }
+
+    function draw(trace) {
+        var gd = graphDiv('sample-graph');
+        if (!gd || !window.Plotly) {
+            return;
+        }
+        var offsets = decode(trace.i, Uint16Array);
+        var values = decode(trace.y, Float32Array);
+        var x = new Array(offsets.length);
+        for (var k = 0; k < offsets.length; k++) {
+            x[k] = (trace.s + offsets[k]) / trace.sr;
+        }
+        window.Plotly.extendTraces(gd, {x: [x], y: [Array.from(values)]}, [0], trace.m);
+    }
+
+    function connect() {
+        var source = new EventSource('/stream');
+        source.onmessage = function (message) {
+            var event = JSON.parse(message.data);
+            if (event.trace) {
+                draw(event.trace);
+            }
+            if (event.bands) {
+                drawBands(event.bands);
+            }
+            if (event.metrics !== undefined) {
+                var panel = document.getElementById('metrics-panel');
+                if (panel) {
+                    panel.textContent = event.metrics;
+                }
+            }
+            if (event.status !== undefined) {
+                var shared = document.getElementById('shared-state');
+                if (shared) {
+                    shared.textContent = event.status;
+                }
+            }
+            if (event.prediction !== undefined) {
+                var state = document.getElementById('prediction-state');
+                if (state) {
+                    state.textContent = event.prediction;
+                }
+            }
+        };
+    }
+
+    if (document.readyState === 'loading') {
+        document.addEventListener('DOMContentLoaded', connect);
+    } else {
+        connect();
+    }
+})();
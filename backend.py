@@ -0,0 +1,152 @@
+import datetime
+import queue
+import threading
+from multiprocessing import Process, Queue
+from time import monotonic
+
+from analysis import RunningWelch
+from classifier import classifier_processing, STATE_NAMES
+from live_stream import FramePublisher
+from metrics import Metrics
+from recorder import SessionRecorder
+from replay import replay_processing
+from ring_buffer import RingBuffer
+from tcp_server import tcp_client_processing
+
+# recording targets of the State buttons: file and label of each
+RECORDINGS = {1: ('./data/state1.npy', 1), 2: ('./data/state2.npy', 0)}
+RECORDING_NAMES = {0: 'Not recording', 1: 'Recording State 1', 2: 'Recording State 0'}
+
+
+class Backend(object):
+    """
+    The single acquisition / classification / recording pipeline shared by every dashboard viewer.
+
+    Owns the shared ring buffer, the acquisition and classifier processes and the recording state; start(),
+    set_recording(), exit() and close() are idempotent, so any number of browser tabs can press the buttons without
+    starting processes twice or desynchronising the recorder. Display frames are computed once by a
+    FramePublisher and fanned out to every /stream connection. Viewer-only state (linked or not, the training
+    job a tab is watching) lives in the browser, see main.py. close() stops everything and frees the shared
+    memory of the ring buffer, call it when the dashboard shuts down.
+    """
+
+    def __init__(self, channels=1, tcp_ip='127.0.0.1', tcp_port=5555, replay_session=None, replay_speed=1.0,
+                 show_metrics=False):
+        self.d = RingBuffer(10000, channels=channels)  # raw datas, record 10s datas (fs = 1000Hz) in shared memory
+        self.q = Queue()  # control signal
+        self.p = Queue(maxsize=64)  # predictions
+        self.m = Queue(maxsize=16)  # metrics snapshots from the acquisition and classifier processes
+        self.metrics = Metrics('dash')  # also collects the acquisition and classifier snapshots, see /metrics
+        if replay_session:
+            # State buttons play / pause the recording, the rest of the pipeline cannot tell the difference
+            self.acquisition = Process(target=replay_processing, args=(self.d, self.q, replay_session, replay_speed),
+                                       kwargs={'loop': True, 'm': self.m})
+        else:
+            self.acquisition = Process(target=tcp_client_processing, args=(self.d, self.q, tcp_ip, tcp_port, self.m))
+        self.classifier = Process(target=classifier_processing, args=(self.d, self.p), kwargs={'m': self.m},
+                                  daemon=True)
+        self.lock = threading.Lock()
+        self.started = False
+        self.stopped = False
+        self.closed = False
+        self.recording = 0  # key of RECORDINGS being recorded, 0 while stopped
+        self.record_cursor = 0  # ring buffer count already handed to the recorders
+        self.last_prediction = None
+        self.live_band_powers = None  # first channel, updated by background_processing
+        self.publisher = FramePublisher(self.d, self.prediction_text, lambda: self.live_band_powers, self.status_text,
+                                        self.metrics if show_metrics else None)
+        self.closing = threading.Event()
+        self.background = threading.Thread(target=self.background_processing, daemon=True)
+        self.background.start()
+
+    def start(self):
+        # the first viewer that links starts acquisition and online classification, later ones just watch
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+            self.acquisition.start()
+            self.classifier.start()
+
+    def set_recording(self, recording):
+        # 0 stops, 1 / 2 record into RECORDINGS[recording]; switching target keeps OpenSignals streaming
+        with self.lock:
+            if not self.started or self.stopped or recording == self.recording:
+                return
+            if recording == 0:
+                self.q.put('1')  # stop
+            elif self.recording == 0:
+                self.q.put('0')  # start
+            self.recording = recording
+
+    def toggle_recording(self, recording):
+        self.set_recording(0 if self.recording == recording else recording)
+
+    def exit(self, timeout=5.0):
+        with self.lock:
+            if not self.started or self.stopped:
+                return
+            self.stopped = True
+            self.recording = 0
+            self.q.put('2')
+        self.acquisition.join(timeout)
+        if self.acquisition.is_alive():
+            self.acquisition.terminate()  # never hang the dash callback on a stuck acquisition process
+
+    def close(self):
+        # exit(), then stop the classifier and the threads reading the ring buffer before it is unlinked
+        self.exit()
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+        if self.classifier.is_alive():
+            self.classifier.terminate()
+            self.classifier.join()
+        self.closing.set()
+        self.background.join()
+        self.publisher.stop()
+        self.d.close()
+
+    def background_processing(self):
+        # keeps the newest prediction, updates the live band powers and records samples while a state is selected
+        self.record_cursor = self.d.count
+        psd_estimator = RunningWelch(welch_tw=0.8, sr=1000, n_segments=4)
+        while not self.closing.is_set():
+            try:
+                while True:
+                    self.last_prediction = self.p.get_nowait()
+            except queue.Empty:
+                pass
+            self.metrics.collect(self.m)
+            self.metrics.set('prediction_queue_depth', self.p.qsize())
+            self.metrics.set('command_queue_depth', self.q.qsize())
+            self.metrics.set('viewers', self.publisher.viewers)
+            if self.d.last_commit is not None:
+                self.metrics.set('buffer_staleness_s', monotonic() - self.d.last_commit)
+            # record every sample that arrived since the last pass
+            new_samples, self.record_cursor = self.d.read_since(self.record_cursor)
+            if new_samples.shape[-1]:
+                psd_estimator.update(new_samples)
+                band_powers = psd_estimator.band_powers()
+                if band_powers is not None:
+                    self.live_band_powers = band_powers if band_powers.ndim == 1 else band_powers[0]
+            if self.recording in RECORDINGS:
+                file_path, label = RECORDINGS[self.recording]
+                SessionRecorder(file_path, channels=self.d.channels, label=label).append(new_samples.T)
+            self.closing.wait(0.2)
+
+    def prediction_text(self):
+        if self.last_prediction is None:
+            return ''
+        timestamp, prediction, latency, overruns, dropped, count = self.last_prediction
+        return (f'{datetime.datetime.fromtimestamp(timestamp):%H:%M:%S.%f}'[:-3]
+                + f' {STATE_NAMES.get(prediction, prediction)} ({latency * 1000:.1f} ms)')
+
+    def status_text(self):
+        # shown to every viewer, so a supervisor sees what the recording station is doing
+        viewers = self.publisher.viewers
+        return f'{RECORDING_NAMES[self.recording]}, {viewers} viewer{"" if viewers == 1 else "s"}'
+
+    def stream(self):
+        return self.publisher.stream()
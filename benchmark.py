@@ -0,0 +1,210 @@
+import argparse
+import os
+import queue
+from bisect import bisect_right
+from multiprocessing import Process, Queue
+from time import monotonic, sleep
+
+import numpy as np
+
+from analysis import SDFT_TOLERANCE, StreamingBandPowers, streaming_band_power_matrix
+from classifier import classifier_processing
+from figures import LiveTrace
+from metrics import Metrics
+from ring_buffer import RingBuffer
+from simulator import OpenSignalsSimulator
+from tcp_server import tcp_client_processing
+
+try:
+    import psutil  # optional, falls back to /proc on Linux
+except ImportError:
+    psutil = None
+
+
+def cpu_seconds(pid):
+    # user + system CPU time of a process, None when it cannot be read on this platform
+    if psutil is not None:
+        try:
+            times = psutil.Process(pid).cpu_times()
+            return times.user + times.system
+        except psutil.Error:
+            return None
+    try:
+        with open(f'/proc/{pid}/stat') as file:
+            fields = file.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def percentiles(values):
+    if not values:
+        return 'n/a'
+    p50, p95, p99 = np.percentile(np.asarray(values) * 1000, [50, 95, 99])
+    return f'p50 {p50:.2f} ms, p95 {p95:.2f} ms, p99 {p99:.2f} ms ({len(values)} samples)'
+
+
+def run_benchmark(duration=10.0, sr=1000, channels=1, frame_size=100, jitter=0.0, burst=1, devices=1,
+                  port=5599, predict=None, display_period=0.02):
+    """
+    End-to-end ingest benchmark against a local OpenSignalsSimulator.
+
+    Runs tcp_client_processing (and, when a trained model exists or predict=True, classifier_processing) in
+    their own processes exactly like main.py, and measures from this process:
+    - sustained ingest throughput and dropped samples (sent by the simulator but never written to the buffer)
+    - CPU seconds per process
+    - sample-to-buffer latency: simulator send -> ring buffer write cursor covers the frame
+    - sample-to-display latency: send -> decimated by a LiveTrace polled at the /stream period
+    - sample-to-prediction latency: send -> prediction computed on that sample received from the queue
+    - the per-stage histograms and counters the child processes publish (see metrics.py)
+    Returns the results as a dict.
+    """
+    if predict is None:
+        predict = os.path.exists('./model/svm_model.joblib')
+    simulator = OpenSignalsSimulator(port=port, sr=sr, channels=channels, frame_size=frame_size, jitter=jitter,
+                                     burst=burst, devices=devices)
+    simulator.start()
+    d = RingBuffer(max(10000, 10 * sr), channels=channels)
+    q = Queue()
+    p = Queue(maxsize=1024)
+    m = Queue(maxsize=16)
+    metrics = Metrics('benchmark')
+    tcp_processing = Process(target=tcp_client_processing, args=(d, q, '127.0.0.1', port, m))
+    tcp_processing.start()
+    processes = {'acquisition': tcp_processing}
+    if predict:
+        classifier_process = Process(target=classifier_processing, args=(d, p), kwargs={'m': m}, daemon=True)
+        classifier_process.start()
+        processes['classifier'] = classifier_process
+    cpu_start = {name: cpu_seconds(process.pid) for name, process in processes.items()}
+    cpu_start['benchmark'] = cpu_seconds(os.getpid())
+
+    # samples per device from the simulator log -> samples in the ring buffer
+    per_send = devices if channels == 1 else 1
+    trace = LiveTrace(window=d.capacity, sr=sr)
+    buffer_latency, display_latency, prediction_latency = [], [], []
+    next_buffer = next_display = 0
+    next_trace = monotonic()
+
+    def match(log_index, covered, now, out):
+        # every logged send that is fully covered by `covered` buffer samples gets a latency sample
+        log = simulator.send_log
+        while log_index < len(log) and log[log_index][0] * per_send <= covered:
+            out.append(now - log[log_index][1])
+            log_index += 1
+        return log_index
+
+    q.put('0')  # start, like the State buttons
+    t_start = monotonic()
+    while monotonic() - t_start < duration:
+        now = monotonic()
+        next_buffer = match(next_buffer, d.count, now, buffer_latency)
+        if now >= next_trace:
+            trace.update_block(d)
+            next_display = match(next_display, trace.cursor, now, display_latency)
+            next_trace += display_period
+        try:
+            while True:
+                prediction = p.get_nowait()
+                log = simulator.send_log
+                sends = [samples * per_send for samples, _ in log]
+                k = bisect_right(sends, prediction[5]) - 1
+                if k >= 0:
+                    prediction_latency.append(monotonic() - log[k][1])
+        except queue.Empty:
+            pass
+        sleep(0.0005)
+    elapsed = monotonic() - t_start
+    ingested = d.count
+
+    cpu = {}
+    for name, process in processes.items():
+        seconds = cpu_seconds(process.pid)
+        cpu[name] = None if seconds is None or cpu_start[name] is None else seconds - cpu_start[name]
+    seconds = cpu_seconds(os.getpid())
+    cpu['benchmark'] = None if seconds is None else seconds - cpu_start['benchmark']
+
+    simulator.isStreaming = False  # stop at the source so nothing is discarded by the client's 'stop'
+    sleep(0.5)  # let frames already in flight arrive
+    sent = simulator.sent_samples * per_send
+    received = d.count
+    sleep(1.0)  # one more publish period of the child processes' stage metrics
+    metrics.collect(m)
+    q.put('1')  # stop
+    q.put('2')
+    tcp_processing.join(timeout=5)
+    for process in processes.values():
+        if process.is_alive():
+            process.terminate()
+    simulator.stop()
+    d.close()
+
+    return {
+        'elapsed_s': elapsed,
+        'sent_samples': sent,
+        'received_samples': received,
+        'dropped_samples': max(sent - received, 0),
+        'throughput_samples_per_s': ingested / elapsed,
+        'cpu_s': cpu,
+        'sample_to_buffer': percentiles(buffer_latency),
+        'sample_to_display': percentiles(display_latency),
+        'sample_to_prediction': percentiles(prediction_latency) if predict else 'disabled (no model)',
+        'stages': metrics.summary(),
+    }
+
+
+def check_features(seconds=30.0, channels=4, sr=1000, window=1, hop=0.05, seed=0):
+    """
+    Regression check of the live features against the training features.
+
+    A drifting multi-channel test signal is pushed through StreamingBandPowers in irregular chunks, like
+    recv() delivers them, and the band powers at the end of every hop are compared with
+    streaming_band_power_matrix over the same recording. Returns the largest relative deviation, which must
+    stay below analysis.SDFT_TOLERANCE.
+    """
+    rng = np.random.default_rng(seed)
+    n = int(seconds * sr)
+    signal = (np.cumsum(rng.normal(size=(channels, n)), axis=1) * 0.1 + rng.normal(size=(channels, n))
+              + np.sin(2 * np.pi * 10 * np.arange(n) / sr) * np.arange(1, channels + 1)[:, None])
+    batch = streaming_band_power_matrix(signal, t_start=0, n_windows=None, window=window, hop=hop, sr=sr,
+                                        settle=seconds)  # filtered from the first sample, like the live side
+    live = StreamingBandPowers(sr=sr)
+    position = 0
+    deviation = 0.0
+    for k, end in enumerate(int(window * sr) + int(hop * sr) * np.arange(batch.shape[1])):
+        while position < end:
+            size = min(int(rng.integers(1, 120)), end - position)
+            live.update(signal[:, position:position + size])
+            position += size
+        deviation = max(deviation, float(np.max(np.abs(live.band_powers() - batch[:, k]) / np.abs(batch[:, k]))))
+    return deviation
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end ingest benchmark with the OpenSignals simulator')
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--sr', type=int, default=1000)
+    parser.add_argument('--channels', type=int, default=1)
+    parser.add_argument('--frame-size', type=int, default=100)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--burst', type=int, default=1)
+    parser.add_argument('--devices', type=int, default=1)
+    parser.add_argument('--port', type=int, default=5599)
+    parser.add_argument('--no-predict', action='store_true')
+    parser.add_argument('--check-features', action='store_true',
+                        help='only check that live features match the training features, exit 1 if not')
+    args = parser.parse_args()
+    if args.check_features:
+        deviation = check_features(sr=args.sr, channels=max(args.channels, 4))
+        print(f'live vs training features: max relative deviation {deviation:.2e} (tolerance {SDFT_TOLERANCE:.0e})')
+        raise SystemExit(0 if deviation < SDFT_TOLERANCE else 1)
+    results = run_benchmark(args.duration, args.sr, args.channels, args.frame_size, args.jitter, args.burst,
+                            args.devices, args.port, predict=False if args.no_predict else None)
+    stages = results.pop('stages')
+    for key, value in results.items():
+        print(f'{key:>26}: {value}')
+    print(stages)
+
+
+if __name__ == '__main__':
+    main()
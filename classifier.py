@@ -0,0 +1,179 @@
+import os
+import queue
+from time import monotonic, sleep, time
+
+from analysis import EEG_BANDS, LEGACY_FEATURES, StreamingBandPowers, band_power_matrix
+from compact_model import CompactSVM
+from metrics import Metrics
+
+STATE_NAMES = {1: "Move", 0: "Stop"}
+
+
+def load_model(path='./model/svm_model.joblib'):
+    # {'scaler', 'svm', 'feature_definition'} saved together by svm_training in one file, so a retrain can never
+    # pair a scaler with an SVM it was not fit with; models saved before then keep the scaler in scaler.joblib
+    # next to the SVM and were trained on the LEGACY_FEATURES
+    from joblib import load  # unpickling imports scikit-learn, only needed without an export
+
+    model = load(path)
+    if not isinstance(model, dict):
+        model = {'scaler': load(os.path.join(os.path.dirname(path), 'scaler.joblib')), 'svm': model}
+    return dict({'feature_definition': LEGACY_FEATURES}, **model)
+
+
+class OnlineClassifier(object):
+    """
+    Classifies the newest window of the shared ring buffer with the trained scaler and SVM.
+
+    Features are computed exactly like the training features of data_extraction.extract_features (EEG_BANDS
+    band powers of the newest welch_tw seconds, channel-major for multi-channel buffers), with the window,
+    welch_tw and streaming the model was trained with. For streaming models only the samples that arrived
+    since the previous call are band-pass filtered and folded into the sliding DFTs of a StreamingBandPowers;
+    otherwise the whole window is re-filtered each time. A model trained at a sample rate other than sr is
+    refused with a ValueError. Predictions go through the NumPy-only CompactSVM: the
+    exported svm_model.npz when it is the newest model, otherwise one built from the scaler and SVM of the
+    joblib model, which skips sklearn's per-call validation. The model files are loaded once and reloaded only
+    when training writes new ones.
+    """
+
+    def __init__(self, d, model_path='./model/svm_model.joblib', compact_path='./model/svm_model.npz', sr=1000):
+        self.d = d
+        self.model_path = model_path
+        self.compact_path = compact_path
+        self.sr = sr
+        self.feature_definition = None
+        self.win = None
+        self.welch_tw = None
+        self.streaming = None
+        self.stream = None
+        self.cursor = None  # ring buffer count already filtered by self.stream
+        self.model = None
+        self.model_mtime = None
+
+    def configure(self, feature_definition):
+        # switches the features to the ones a model was trained on
+        if feature_definition['sr'] != self.sr:
+            raise ValueError(f"model trained on {feature_definition['sr']} Hz features, the stream is {self.sr} Hz")
+        if feature_definition == self.feature_definition:
+            return
+        self.feature_definition = feature_definition
+        self.win = int(feature_definition['window'] * self.sr)
+        self.welch_tw = feature_definition['welch_tw']
+        self.streaming = feature_definition['streaming']
+        self.stream = StreamingBandPowers(welch_tw=self.welch_tw, sr=self.sr, bands=EEG_BANDS)
+        self.cursor = None
+
+    def load(self):
+        # returns True when a model is ready, reloading it if it was retrained; a refused model (ValueError)
+        # is not retried until it changes, the previous one keeps classifying
+        mtimes = []
+        for path in (self.model_path, self.compact_path):
+            try:
+                mtimes.append(os.path.getmtime(path))
+            except OSError:
+                mtimes.append(None)
+        model_mtime, compact_mtime = mtimes
+        if model_mtime is None and compact_mtime is None:
+            return self.model is not None
+        if mtimes != self.model_mtime:
+            self.model_mtime = mtimes
+            if compact_mtime is not None and (model_mtime is None or compact_mtime >= model_mtime):
+                model = CompactSVM.load(self.compact_path)
+                model.feature_definition = model.feature_definition or LEGACY_FEATURES
+            else:
+                saved = load_model(self.model_path)
+                model = CompactSVM.from_estimator(saved['svm'], saved['scaler'],
+                                                  feature_definition=saved['feature_definition'])
+            self.configure(model.feature_definition)
+            self.model = model
+        return self.model is not None
+
+    def features(self):
+        if self.streaming:
+            if self.cursor is None or self.d.count - self.cursor > self.d.capacity:
+                # first call or samples were overwritten before we read them: restart the filters on the
+                # whole buffer, which also lets them settle
+                self.stream.reset()
+                self.cursor = max(self.d.count - self.d.capacity, 0)
+            new_samples, self.cursor = self.d.read_since(self.cursor)
+            self.stream.update(new_samples)
+            return self.stream.band_powers().reshape(1, -1)
+        window = self.d.snapshot(self.win)  # (win,) or (channels, win)
+        return band_power_matrix(window, bands=EEG_BANDS, welch_tw=self.welch_tw, sr=self.sr).reshape(1, -1)
+
+    def predict(self, features):
+        return int(self.model.predict(features)[0])
+
+    def predict_latest(self):
+        return self.predict(self.features())
+
+
+def publish(p, item):
+    # keep the newest predictions, drop the oldest one when the consumer falls behind; True if one was dropped
+    try:
+        p.put_nowait(item)
+        return False
+    except queue.Full:
+        try:
+            p.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            p.put_nowait(item)
+        except queue.Full:
+            pass
+        return True
+
+
+def classifier_processing(d, p, hop=0.05, latency_budget=0.025, m=None):
+    """
+    Publishes (timestamp, prediction, latency, overruns, dropped, count) to p every hop seconds while new
+    samples arrive; count is the ring buffer sample count the prediction was computed on.
+
+    A prediction that takes longer than latency_budget is still published but counted as an overrun; when
+    the loop falls behind, the missed hops are dropped instead of being computed late. Stage timings and
+    counters are published to m when given.
+    """
+    engine = OnlineClassifier(d)
+    metrics = Metrics('classifier')
+    last_count = -1
+    overruns = dropped = 0
+    next_tick = monotonic()
+    while True:
+        metrics.publish(m)
+        now = monotonic()
+        if now < next_tick:
+            sleep(next_tick - now)
+        elif now - next_tick >= hop:
+            missed = int((now - next_tick) // hop)
+            dropped += missed
+            metrics.inc('dropped_hops', missed)
+            next_tick += missed * hop
+        next_tick += hop
+
+        try:
+            ready = engine.load()
+        except ValueError:
+            metrics.inc('models_refused')
+            ready = engine.model is not None
+        if not ready:
+            continue
+        count = d.count
+        if count == last_count or count < engine.win:
+            continue  # no new samples since the last decision
+        last_count = count
+
+        t0 = monotonic()
+        features = engine.features()
+        t_features = monotonic()
+        prediction = engine.predict(features)
+        t_predicted = monotonic()
+        latency = t_predicted - t0
+        metrics.observe('feature', t_features - t0)
+        metrics.observe('predict', t_predicted - t_features)
+        metrics.observe('sample_to_prediction', t_predicted - d.last_commit)
+        if latency > latency_budget:
+            overruns += 1
+            metrics.inc('latency_overruns')
+        if publish(p, (time(), prediction, latency, overruns, dropped, count)):
+            metrics.inc('prediction_queue_drops')
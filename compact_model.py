@@ -0,0 +1,105 @@
+import json
+
+import numpy as np
+
+from recorder import replace_file
+
+
+class CompactSVM(object):
+    """
+    Scaler + RBF SVM as plain arrays, with a pure-NumPy batched predictor.
+
+    Holds the StandardScaler mean / scale, the support vectors, the one-vs-one dual coefficients, intercepts
+    and gamma of a fitted sklearn SVC and reproduces its decisions without importing scikit-learn. With
+    rff_components the kernel expansion is replaced by random Fourier features: every class pair collapses
+    to one weight vector, so a prediction costs rff_components x features whatever the number of support
+    vectors, at the price of an approximate decision close to the boundary. feature_definition records the
+    features the model expects (analysis.feature_definition), None for models exported without one.
+    """
+
+    def __init__(self, mean, scale, support_vectors, dual_coef, intercept, gamma, classes, n_support,
+                 rff_weights=None, rff_offsets=None, rff_coef=None, feature_definition=None):
+        self.mean = np.asarray(mean, dtype=np.float64)
+        self.scale = np.asarray(scale, dtype=np.float64)
+        self.support_vectors = np.asarray(support_vectors, dtype=np.float64)
+        self.dual_coef = np.asarray(dual_coef, dtype=np.float64)  # libsvm sign: positive -> first class
+        self.intercept = np.asarray(intercept, dtype=np.float64)
+        self.gamma = float(gamma)
+        self.classes = np.asarray(classes)
+        self.n_support = np.asarray(n_support, dtype=np.int64)
+        self.rff_weights = rff_weights
+        self.rff_offsets = rff_offsets
+        self.rff_coef = rff_coef
+        self.feature_definition = feature_definition
+        self.sv_norms = np.einsum('ij,ij->i', self.support_vectors, self.support_vectors)
+        # one-vs-one pairs in libsvm order, with the coefficient of every support vector in that pair's sum
+        bounds = np.concatenate(([0], np.cumsum(self.n_support)))
+        self.pairs = []
+        self.pair_coef = np.zeros((len(self.support_vectors), len(self.intercept)))
+        for i in range(len(self.classes)):
+            for j in range(i + 1, len(self.classes)):
+                k = len(self.pairs)
+                self.pairs.append((i, j))
+                self.pair_coef[bounds[i]:bounds[i + 1], k] = self.dual_coef[j - 1, bounds[i]:bounds[i + 1]]
+                self.pair_coef[bounds[j]:bounds[j + 1], k] = self.dual_coef[i, bounds[j]:bounds[j + 1]]
+
+    @classmethod
+    def from_estimator(cls, clf, scaler, rff_components=None, seed=0, feature_definition=None):
+        # sklearn flips the sign of the public binary coefficients, libsvm's own convention is kept here
+        sign = -1 if len(clf.classes_) == 2 else 1
+        gamma = clf._gamma if isinstance(clf.gamma, str) else clf.gamma
+        model = cls(scaler.mean_, scaler.scale_, clf.support_vectors_, sign * clf.dual_coef_,
+                    sign * clf.intercept_, gamma, clf.classes_, clf.n_support_,
+                    feature_definition=feature_definition)
+        if rff_components:
+            model.fit_rff(rff_components, seed)
+        return model
+
+    def fit_rff(self, rff_components, seed=0):
+        # exp(-gamma |x - y|^2) ~= z(x) . z(y), z(x) = sqrt(2 / D) cos(W x + b), W ~ N(0, 2 gamma), b ~ U(0, 2 pi)
+        rng = np.random.default_rng(seed)
+        n_features = self.support_vectors.shape[1]
+        self.rff_weights = rng.normal(0, np.sqrt(2 * self.gamma), (n_features, rff_components))
+        self.rff_offsets = rng.uniform(0, 2 * np.pi, rff_components)
+        self.rff_coef = self._rff(self.support_vectors).T @ self.pair_coef
+
+    def _rff(self, X):
+        return np.sqrt(2 / len(self.rff_offsets)) * np.cos(X @ self.rff_weights + self.rff_offsets)
+
+    def decision_function(self, X):
+        # (n, pairs) one-vs-one decision values of raw feature rows, positive votes for the pair's first class
+        X = (np.atleast_2d(np.asarray(X, dtype=np.float64)) - self.mean) / self.scale
+        if self.rff_coef is not None:
+            return self._rff(X) @ self.rff_coef + self.intercept
+        sq_dist = np.einsum('ij,ij->i', X, X)[:, None] + self.sv_norms - 2 * X @ self.support_vectors.T
+        kernel = np.exp(-self.gamma * np.maximum(sq_dist, 0))
+        return kernel @ self.pair_coef + self.intercept
+
+    def predict(self, X):
+        decision = self.decision_function(X)
+        if len(self.classes) == 2:
+            return self.classes[(decision[:, 0] <= 0).astype(np.int64)]
+        votes = np.zeros((len(decision), len(self.classes)), dtype=np.int64)
+        for k, (i, j) in enumerate(self.pairs):
+            positive = decision[:, k] > 0
+            votes[:, i] += positive
+            votes[:, j] += ~positive
+        return self.classes[np.argmax(votes, axis=1)]  # ties go to the lower class, like libsvm
+
+    def save(self, path='./model/svm_model.npz'):
+        arrays = dict(mean=self.mean, scale=self.scale, support_vectors=self.support_vectors,
+                      dual_coef=self.dual_coef, intercept=self.intercept, gamma=self.gamma, classes=self.classes,
+                      n_support=self.n_support)
+        if self.rff_coef is not None:
+            arrays.update(rff_weights=self.rff_weights, rff_offsets=self.rff_offsets, rff_coef=self.rff_coef)
+        if self.feature_definition is not None:
+            arrays.update(feature_definition=json.dumps(self.feature_definition))
+        replace_file(path, lambda file: np.savez(file, **arrays))
+
+    @classmethod
+    def load(cls, path='./model/svm_model.npz'):
+        with np.load(path, allow_pickle=False) as arrays:
+            fields = {name: arrays[name] for name in arrays.files}
+        if 'feature_definition' in fields:
+            fields['feature_definition'] = json.loads(str(fields['feature_definition']))
+        return cls(**fields)
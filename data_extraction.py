@@ -1,61 +1,11 @@
+import os
 import re
-from scipy.signal import welch, filtfilt, butter, lfilter
-from numpy import array, mean, logical_and, trapz
-
-
-def baseline_shift(signal_uv: list, t_start, t_end, sr=1000, ):
-    # Time window
-    # t_start: lower limit of time window (s)
-    sample_start = int(t_start * sr)
-    # t_end: upper limit of time window (s)
-    sample_end = int(t_end * sr)
-
-    # Cutoff frequencies: f1, f2
-    # Baseline shift of window
-    signal_shift_window = array(signal_uv[sample_start:sample_end]) - mean(
-        array(signal_uv[sample_start:sample_end]))
-    return signal_shift_window
-
-
-def filtered(signal_uv: list, f1=3, f2=30, sr=1000):
-    # Digital Bandpass filtering with cutoff frequencies of f1=3 and f2=30 Hz using bandpass
-    filtered_signal = bandpass(signal_uv, f1, f2, order=2, fs=sr)
-
-    return filtered_signal
-
-
-def show_psd(signal_uv: list, welch_tw=4, sr=1000):
-    # Time Windows for Welchs method
-    win = welch_tw * sr  # welch_tw seconds time windows.
-
-    # FFT with time windows using scipy.signal.welch
-    freq_axis, power_spect = welch(signal_uv, sr, nperseg=win)
-    return freq_axis, power_spect
-
-
-def clc_power(freq_axis, power_spect, freq_low=8, freq_high=12):
-    # Define Frequency Band limits: freq_low, freq_high
-    # Find the intersection Values of the alpha band in the frequency vector [Eyes Closed]
-    idx_alpha = logical_and(freq_axis >= freq_low, freq_axis <= freq_high)
-    # Frequency Resolution
-    try:
-        freq_res = freq_axis[1] - freq_axis[0]
-    except IndexError:
-        freq_res = 1
-
-    # Compute the Absolute Power with numpy.trapz:
-    alpha_power = trapz(power_spect[idx_alpha], dx=freq_res)
-    alpha_power = round(alpha_power, 2)
-    return alpha_power
-
-
-def bandpass(s, f1, f2, order=2, fs=1000.0, use_filtfilt=False):
-    [b, a] = butter(Wn=[f1 * 2 / fs, f2 * 2 / fs], btype='bandpass', N=order, output='ba')
-
-    if use_filtfilt:
-        return filtfilt(b, a, s)
-
-    return lfilter(b, a, s)
+from multiprocessing import Pool
+import numpy as np
+import pandas as pd
+from numpy import array
+from analysis import EEG_BANDS, band_power_matrix, feature_definition, sliding_windows, streaming_band_power_matrix
+from recorder import info_path, load_session, session_info
 
 
 def convert_to_single_column(file_path):
@@ -72,59 +22,155 @@ def convert_to_single_column(file_path):
     return numbers
 
 
+def load_recording(file_path):
+    # binary sessions are memory-mapped, old text recordings are still parsed
+    if file_path.endswith('.npy'):
+        return load_session(file_path)
+    return array(convert_to_single_column(file_path))
+
+
+# default feature extraction parameters: 500 one-second windows from t = 8 s like the original training setup,
+# but streaming=True features (see analysis.StreamingBandPowers). Models record the definition they were
+# trained on (analysis.feature_definition), so models trained on the original streaming=False features keep
+# getting those from the online classifier
+FEATURE_PARAMS = dict(t_start=8, n_windows=500, window=1, hop=0.05, welch_tw=0.8, sr=1000, streaming=True)
+
+
+def extract_features(file_path, t_start=8, n_windows=500, window=1, hop=0.05, welch_tw=0.8, sr=1000,
+                     streaming=True, batch_windows=500):
+    # (windows, channels * bands) band powers of one recording, channel-major like feature_names().
+    # n_windows=None uses every window in the recording. Windows are processed batch_windows at a time so
+    # memory stays bounded on long sessions; all channels of a batch go through one vectorized call.
+    # streaming=False filters every window on its own from zero state, the original feature definition.
+    data_list = load_recording(file_path)
+    data_list = data_list.T if data_list.ndim == 2 else data_list[None, :]  # (channels, samples)
+    if streaming:
+        powers = streaming_band_power_matrix(data_list, t_start=t_start, n_windows=n_windows, window=window,
+                                             hop=hop, welch_tw=welch_tw, sr=sr, bands=EEG_BANDS,
+                                             batch_windows=batch_windows)
+        return powers.transpose(1, 0, 2).reshape(powers.shape[1], powers.shape[0] * len(EEG_BANDS))
+    windows = sliding_windows(data_list, t_start=t_start, n_windows=n_windows, window=window, hop=hop, sr=sr)
+    channels, n = windows.shape[0], windows.shape[1]
+    if n == 0:
+        return np.empty((0, channels * len(EEG_BANDS)))
+    powers = np.concatenate([band_power_matrix(windows[:, i:i + batch_windows], bands=EEG_BANDS,
+                                               welch_tw=welch_tw, sr=sr)
+                             for i in range(0, n, batch_windows)], axis=1)
+    return powers.transpose(1, 0, 2).reshape(n, channels * len(EEG_BANDS))
+
+
+def feature_names(channels=1):
+    # band names for a single channel, ch<i>_<band> for multi-channel recordings
+    if channels == 1:
+        return [name for name, _, _ in EEG_BANDS]
+    return [f'ch{c}_{name}' for c in range(channels) for name, _, _ in EEG_BANDS]
+
+
 def output_psd_txt(file_path):
     # 使用此函数
-    # file_path = "state2.txt"
-    values = convert_to_single_column(file_path)
-
-    data_list = list(values)
-
-    welch_tw = 0.8
-    psd_sr = 1000
-    freq_low_delta, freq_high_delta = 2, 4
-    freq_low_theta, freq_high_theta = 4, 8
-    freq_low_alpha, freq_high_alpha = 8, 14
-    freq_low_beta, freq_high_beta = 14, 30
-    freq_low_gamma, freq_high_gamma = 30, 100
-
-    input_a, input_b, n = 8, 9, 0
-    file_name = f"ttt_cvt.txt"
-    if file_path == './data/state1.txt':
-        file_name = f"./data/state1_cvt.txt"
-    elif file_path == './data/state2.txt':
-        file_name = f"./data/state2_cvt.txt"
-
-    while n < 500:
-        bs_data = baseline_shift(data_list, t_start=input_a, t_end=input_b)
-
-        filter_delta = filtered(bs_data, f1=freq_low_delta, f2=freq_high_delta, sr=psd_sr)
-        psd_delta = show_psd(filter_delta, welch_tw=welch_tw, sr=psd_sr)
-        power_delta = clc_power(psd_delta[0], psd_delta[1], freq_low=freq_low_delta, freq_high=freq_high_delta)
-        # Theta
-        filter_theta = filtered(bs_data, f1=freq_low_theta, f2=freq_high_theta, sr=psd_sr)
-        psd_theta = show_psd(filter_theta, welch_tw=welch_tw, sr=psd_sr)
-        power_theta = clc_power(psd_theta[0], psd_theta[1], freq_low=freq_low_theta, freq_high=freq_high_theta)
-        # Alpha
-        filter_alpha = filtered(bs_data, f1=freq_low_alpha, f2=freq_high_alpha, sr=psd_sr)
-        psd_alpha = show_psd(filter_alpha, welch_tw=welch_tw, sr=psd_sr)
-        power_alpha = clc_power(psd_alpha[0], psd_alpha[1], freq_low=freq_low_alpha, freq_high=freq_high_alpha)
-        # Beta
-        filter_beta = filtered(bs_data, f1=freq_low_beta, f2=freq_high_beta, sr=psd_sr)
-        psd_beta = show_psd(filter_beta, welch_tw=welch_tw, sr=psd_sr)
-        power_beta = clc_power(psd_beta[0], psd_beta[1], freq_low=freq_low_beta, freq_high=freq_high_beta)
-        # Gamma
-        filter_gamma = filtered(bs_data, f1=freq_low_gamma, f2=freq_high_gamma, sr=psd_sr)
-        psd_gamma = show_psd(filter_gamma, welch_tw=welch_tw, sr=psd_sr)
-        power_gamma = clc_power(psd_gamma[0], psd_gamma[1], freq_low=freq_low_gamma, freq_high=freq_high_gamma)
-
-        abs_power = [power_delta, power_theta, power_alpha, power_beta, power_gamma]
-        power = f'{abs_power[0]},\t{abs_power[1]},\t{abs_power[2]},\t{abs_power[3]},\t{abs_power[4]}\n'
-
-        # print(power)
-
-        with open(file_name, "a") as file:
-            # if not file_name == 'datas.txt':
-            file.write(power)
-        n = n + 1
-        input_a = input_a + 0.05
-        input_b = input_b + 0.05
+    # file_path = "./data/state2.npy"
+    file_name = os.path.splitext(file_path)[0] + "_cvt.txt"  # ./data/state1.npy -> ./data/state1_cvt.txt
+
+    # 500 one-second windows from t = 8 s, stepped by 50 ms, all bands computed in one pass
+    abs_power = extract_features(file_path, **FEATURE_PARAMS)
+
+    power = ''.join(',\t'.join(str(p) for p in row) + '\n' for row in abs_power.tolist())
+    with open(file_name, "w") as file:  # rewritten, appending would duplicate earlier rows
+        file.write(power)
+
+
+def find_recordings(data_dir='./data'):
+    # every labelled binary session in data_dir, as build_feature_table entries
+    recordings = []
+    for file_name in sorted(os.listdir(data_dir)):
+        file_path = os.path.join(data_dir, file_name)
+        if not file_name.endswith('.npy') or not os.path.exists(info_path(file_path)):
+            continue
+        info = session_info(file_path)
+        if info.get('label') is None:
+            continue
+        recordings.append({'path': file_path, 'label': info['label'],
+                           'session': info.get('session', os.path.splitext(file_name)[0]),
+                           'subject': info.get('subject', '')})
+    return recordings
+
+
+def _recording_params(recording, params):
+    # a recording with a 'start' sample only contributes the windows from there to its current end
+    if recording.get('start') is None:
+        return params
+    return dict(params, t_start=recording['start'] / params['sr'], n_windows=None)
+
+
+def _covered(recording, params, n_windows):
+    # end sample (exclusive) of the last of n_windows windows extracted with _recording_params, where the next
+    # extraction with recording['start'] picks up; the recording's start when there were none
+    if not n_windows:
+        return recording.get('start') or 0
+    sample_start = int(round(params['t_start'] * params['sr']))
+    return sample_start + int(round(params['window'] * params['sr'])) \
+        + (n_windows - 1) * int(round(params['hop'] * params['sr']))
+
+
+def _extract_recording(args):
+    recording, params = args
+    return extract_features(recording['path'], **params)
+
+
+def build_feature_table(recordings, processes=None, max_tasks_per_child=4, cache=None, **params):
+    """
+    Band-power features of many recordings, extracted in parallel and merged into one labelled table.
+
+    recordings: iterable of dicts with 'path' and 'label', optionally 'session', 'subject' and 'start' (first
+    sample to use, e.g. the end of the part a model was already trained on)
+    processes: worker count (default: all cores); each worker memory-maps one recording at a time and is
+    replaced after max_tasks_per_child recordings, which keeps per-worker memory bounded.
+    cache: optional FeatureCache, only recordings that are new or changed are extracted
+    params: overrides of FEATURE_PARAMS
+    Returns a DataFrame with one column per band plus state (label), session, subject and timestamp (window
+    start, epoch seconds). attrs['feature_definition'] holds the feature definition and attrs['covered'] the
+    end sample of every recording's last window, by path, e.g. the 'start' of a later extraction; see
+    feature_store.FeatureStore to keep the table on disk.
+    """
+    recordings = [dict(r) for r in recordings]
+    params = dict(FEATURE_PARAMS, **params)
+    results = [None] * len(recordings)
+    keys = [None] * len(recordings)
+    if cache is not None:
+        for i, recording in enumerate(recordings):
+            keys[i] = cache.key(recording['path'], _recording_params(recording, params))
+            results[i] = cache.get(keys[i])
+
+    missing = [i for i, features in enumerate(results) if features is None]
+    jobs = [(recordings[i], _recording_params(recordings[i], params)) for i in missing]
+    if processes == 1 or len(jobs) <= 1:
+        extracted = [_extract_recording(job) for job in jobs]
+    else:
+        with Pool(processes, maxtasksperchild=max_tasks_per_child) as pool:
+            extracted = pool.map(_extract_recording, jobs, chunksize=1)
+    for i, features in zip(missing, extracted):
+        results[i] = features
+        if cache is not None:
+            cache.put(keys[i], features)
+
+    frames = []
+    covered = {}
+    column_names = feature_names()
+    for recording, features in zip(recordings, results):
+        column_names = feature_names(features.shape[1] // len(EEG_BANDS))
+        df = pd.DataFrame(features, columns=column_names)
+        df["state"] = recording['label']
+        df["session"] = recording.get('session', os.path.splitext(os.path.basename(recording['path']))[0])
+        df["subject"] = recording.get('subject', '')
+        # window start times, from the session's start timestamp when it was recorded by SessionRecorder
+        recording_params = _recording_params(recording, params)
+        start = session_info(recording['path']).get('start_timestamp', 0.0) \
+            if os.path.exists(info_path(recording['path'])) else 0.0
+        df["timestamp"] = start + recording_params['t_start'] + np.arange(len(df)) * recording_params['hop']
+        frames.append(df)
+        covered[recording['path']] = _covered(recording, recording_params, len(df))
+    table = pd.concat(frames, ignore_index=True) if frames else \
+        pd.DataFrame(columns=column_names + ["state", "session", "subject", "timestamp"])
+    table.attrs['feature_definition'] = feature_definition(params)
+    table.attrs['covered'] = covered
+    return table
@@ -0,0 +1,60 @@
+import hashlib
+import json
+import os
+import numpy as np
+
+from analysis import EEG_BANDS
+from recorder import replace_file
+
+
+class FeatureCache(object):
+    """
+    On-disk cache of feature matrices keyed by the recording content and the extraction parameters.
+
+    The key is a SHA-256 of the raw recording bytes plus window, hop, welch_tw, sample rate and band edges,
+    so renamed files still hit and any change to the data or the parameters misses. Entries are .npy files;
+    a hit refreshes the file's mtime and the least recently used entries are evicted once the cache grows
+    beyond max_bytes.
+    """
+
+    def __init__(self, cache_dir='./cache/features', max_bytes=256 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, file_path, params, bands=EEG_BANDS):
+        digest = hashlib.sha256()
+        with open(file_path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1 << 20), b''):
+                digest.update(chunk)
+        digest.update(json.dumps({'params': params, 'bands': bands}, sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.npy')
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            features = np.load(path)
+        except (OSError, ValueError):
+            return None
+        os.utime(path)  # mark as recently used
+        return features
+
+    def put(self, key, features):
+        replace_file(self._path(key), lambda file: np.save(file, np.asarray(features)))
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for file_name in os.listdir(self.cache_dir):
+            if file_name.endswith('.npy'):
+                stat = os.stat(os.path.join(self.cache_dir, file_name))
+                entries.append((stat.st_mtime, stat.st_size, file_name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, file_name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.cache_dir, file_name))
+            total -= size
@@ -0,0 +1,150 @@
+import json
+import os
+
+import numpy as np
+
+from recorder import append_npy, create_npy, replace_file
+
+# one file per column, the band powers form a (rows, features) float32 matrix whose columns are the bands
+_COLUMNS = (('features', np.float32), ('label', np.int64), ('session', np.int32), ('subject', np.int32),
+            ('timestamp', np.float64))
+
+
+class FeatureSelection(object):
+    # rows of a FeatureStore; X and the other columns are memory-mapped views when the rows are contiguous
+    def __init__(self, columns, X, y, session, subject, timestamp, feature_definition=None):
+        self.columns = columns
+        self.X = X
+        self.y = y
+        self.session = session
+        self.subject = subject
+        self.timestamp = timestamp
+        self.feature_definition = feature_definition  # see analysis.feature_definition, None if unknown
+
+    def __len__(self):
+        return len(self.y)
+
+
+class FeatureStore(object):
+    """
+    Binary, indexed store of labelled band-power windows, replacing the *_cvt.txt text files.
+
+    Every column is an .npy file that is memory-mapped on read and grown in place on append: the float32
+    band powers (rows, features), an integer label, session and subject codes and the window start time (epoch
+    seconds). index.json holds the feature names and definition, the session / subject names the codes refer
+    to and one segment (rows, session, subject, labels) per appended recording, so select() finds the rows of
+    a subject, session or label without reading the columns. Any number of classes and subjects can be stored.
+    """
+
+    def __init__(self, root='./data/features'):
+        self.root = root
+
+    def _path(self, name):
+        return os.path.join(self.root, name + '.npy')
+
+    def index(self):
+        try:
+            with open(os.path.join(self.root, 'index.json'), 'r') as file:
+                return json.load(file)
+        except OSError:
+            return None
+
+    def _write_index(self, index):
+        replace_file(os.path.join(self.root, 'index.json'), lambda file: file.write(json.dumps(index).encode()))
+
+    def exists(self):
+        return self.index() is not None
+
+    def __len__(self):
+        index = self.index()
+        return 0 if index is None else index['rows']
+
+    def write(self, table):
+        # replaces the store with a feature table from data_extraction.build_feature_table
+        os.makedirs(self.root, exist_ok=True)
+        if os.path.exists(os.path.join(self.root, 'index.json')):
+            os.remove(os.path.join(self.root, 'index.json'))
+        columns = [c for c in table.columns if c not in ('state', 'session', 'subject', 'timestamp')]
+        for name, dtype in _COLUMNS:
+            create_npy(self._path(name), dtype, (len(columns),) if name == 'features' else ())
+        self._write_index({'columns': columns, 'feature_definition': table.attrs.get('feature_definition'),
+                           'sessions': [], 'subjects': [], 'segments': [], 'rows': 0})
+        self.append(table)
+
+    def append(self, table):
+        # adds the rows of a feature table, one segment per session
+        index = self.index()
+        if index is None:
+            return self.write(table)
+        definition = table.attrs.get('feature_definition')
+        if definition is not None and index.get('feature_definition') not in (None, definition):
+            raise ValueError(f"features extracted with {definition}, the store holds {index['feature_definition']}")
+        if not len(table):
+            return
+        if 'timestamp' not in table:
+            table = table.assign(timestamp=0.0)
+        for session, rows in table.groupby('session', sort=False):
+            subject = str(rows['subject'].iloc[0])
+            for names, name in ((index['sessions'], str(session)), (index['subjects'], subject)):
+                if name not in names:
+                    names.append(name)
+            labels = rows['state'].to_numpy(dtype=np.int64)
+            start = index['rows']
+            columns = {'features': rows[index['columns']].to_numpy(dtype=np.float32), 'label': labels,
+                       'session': np.full(len(rows), index['sessions'].index(str(session))),
+                       'subject': np.full(len(rows), index['subjects'].index(subject)),
+                       'timestamp': rows['timestamp'].to_numpy(dtype=np.float64)}
+            for name, dtype in _COLUMNS:
+                # from the last indexed row: rows an interrupted append left behind are overwritten
+                append_npy(self._path(name), columns[name], dtype,
+                           (len(index['columns']),) if name == 'features' else (), start=start)
+            index['rows'] = start + len(rows)
+            index['segments'].append({'session': str(session), 'subject': subject, 'start': start,
+                                      'stop': index['rows'], 'labels': sorted(set(labels.tolist()))})
+        self._write_index(index)
+
+    def sessions(self):
+        return list(self.index()['sessions'])
+
+    def subjects(self):
+        return list(self.index()['subjects'])
+
+    def labels(self):
+        return sorted({label for segment in self.index()['segments'] for label in segment['labels']})
+
+    def select(self, subject=None, session=None, label=None):
+        """
+        Rows matching every given filter; each filter is a value or a list of values.
+
+        Segments are picked from the index; when they form one contiguous run of rows (a whole store, or
+        consecutive sessions) every column is a slice of its memory map and nothing is copied.
+        """
+        index = self.index()
+
+        def matches(value, wanted):
+            return wanted is None or value in (wanted if isinstance(wanted, (list, tuple, set)) else [wanted])
+
+        wanted_labels = None if label is None else (set(label) if isinstance(label, (list, tuple, set)) else {label})
+        segments = [s for s in index['segments'] if matches(s['subject'], subject) and
+                    matches(s['session'], session) and (wanted_labels is None or wanted_labels & set(s['labels']))]
+        ranges = []
+        for segment in segments:
+            if ranges and ranges[-1][1] == segment['start']:
+                ranges[-1][1] = segment['stop']
+            else:
+                ranges.append([segment['start'], segment['stop']])
+
+        columns = {name: np.load(self._path(name), mmap_mode='r') for name, _ in _COLUMNS}
+        if len(ranges) == 1:
+            rows = slice(*ranges[0])
+        else:
+            rows = np.concatenate([np.arange(start, stop) for start, stop in ranges] or [np.empty(0, dtype=int)])
+        if wanted_labels is not None and any(set(s['labels']) - wanted_labels for s in segments):
+            # a segment mixes labels, only this case needs a row mask
+            rows = np.arange(index['rows'])[rows]
+            rows = rows[np.isin(columns['label'][rows], list(wanted_labels))]
+        selected = {name: column[rows] for name, column in columns.items()}
+        return FeatureSelection(index['columns'], selected['features'], selected['label'],
+                                np.asarray(index['sessions'] or [''])[selected['session']],
+                                np.asarray(index['subjects'] or [''])[selected['subject']],
+                                selected['timestamp'], index.get('feature_definition'))
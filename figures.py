@@ -1,15 +1,16 @@
 import numpy as np
-import pandas as pd
 import plotly.graph_objs as go
 
+from analysis import EEG_BANDS
+
+
+GRAPH_WIDTH = 1400  # px, the live trace is decimated to about one point per pixel
+
 
 def init_figs():
-    # global figure
-    array_length = 10000
-    df = pd.DataFrame({"t/s": np.linspace(0, 11, array_length), "uV": np.zeros(array_length)})
-    global_fig = go.Figure(data=[go.Scatter(x=df["t/s"], y=df["uV"], name='Data 1')])
-    # print(df["t/s"])
-    global_fig.update_layout(autosize=False, width=1400, height=400, plot_bgcolor='white',
+    # global figure, starts empty and is extended with decimated samples (see LiveTrace)
+    global_fig = go.Figure(data=[go.Scatter(x=[], y=[], name='Data 1')])
+    global_fig.update_layout(autosize=False, width=GRAPH_WIDTH, height=400, plot_bgcolor='white',
                              paper_bgcolor='rgba(0,0,0,0)')
     global_fig.update_traces(line=dict(color="#CF382A", width=1))
     global_fig.update_xaxes(gridcolor="#B8B8B8")
@@ -28,13 +29,56 @@ def init_figs():
     # psd_fig.update_yaxes(range=[0, 5])
 
     # psd figure
-    freq_ranges = ["Delta", "Theta", "Alpha", "Beta", "Gamma"]
-    brainwaves = ["0.5-4 Hz", "4-8 Hz", "8-14 Hz", "14-30 Hz", "30-100 Hz"]
-    intensity = [10, 10, 10, 10, 10]
+    # same band edges as the training features
+    freq_ranges = [name for name, _, _ in EEG_BANDS]
+    brainwaves = [f"{f1}-{f2} Hz" for _, f1, f2 in EEG_BANDS]
+    intensity = [0] * len(EEG_BANDS)
 
     trace = go.Bar(x=brainwaves, y=intensity, text=freq_ranges, marker=dict(color='#163a6c'))
-    layout = go.Layout(xaxis=dict(title="Brainwave Type"), yaxis=dict(title="Frequency Intensity", range=[0, 30]),
+    layout = go.Layout(xaxis=dict(title="Brainwave Type"), yaxis=dict(title="Frequency Intensity", autorange=True),
                        plot_bgcolor='white', width=500, height=400)
     psd_fig = go.Figure(data=[trace], layout=layout)
 
     return global_fig, psd_fig
+
+
+def min_max_decimate(y, bucket):
+    # keeps the min and the max of every full bucket of samples, in time order: (sample offsets, values)
+    n = len(y) // bucket * bucket
+    blocks = np.asarray(y[:n]).reshape(-1, bucket)
+    i_min, i_max = blocks.argmin(axis=1), blocks.argmax(axis=1)
+    first = np.minimum(i_min, i_max)
+    second = np.maximum(i_min, i_max)
+    starts = np.arange(0, n, bucket)
+    idx = np.column_stack((starts + first, starts + second)).ravel()
+    return idx, np.asarray(y)[idx]
+
+
+class LiveTrace(object):
+    """
+    Incremental, decimated live trace for the sample graph.
+
+    Each update only decimates samples that arrived since the previous one (min/max per bucket, sized so the
+    visible window maps to about one point per pixel), so the browser extends the trace instead of receiving
+    the whole window as a new figure.
+    """
+
+    def __init__(self, window=10000, sr=1000, width=GRAPH_WIDTH):
+        self.sr = sr
+        self.bucket = max(1, 2 * window // width)  # two points (min, max) per bucket
+        self.max_points = 2 * (window // self.bucket)
+        self.cursor = 0  # first sample not yet drawn
+
+    def update_block(self, d, channel=0):
+        # (first sample index, sample offsets, values) of the newly decimated samples, None until a bucket is full
+        new_samples, count = d.read_since(self.cursor)
+        if new_samples.ndim > 1:
+            new_samples = new_samples[channel]
+        start = count - len(new_samples)
+        n_full = len(new_samples) // self.bucket * self.bucket
+        if n_full == 0:
+            self.cursor = start
+            return None
+        idx, values = min_max_decimate(new_samples[:n_full], self.bucket)
+        self.cursor = start + n_full
+        return start, idx, values
@@ -0,0 +1,130 @@
+import base64
+import json
+import threading
+from collections import deque
+from time import monotonic
+
+import numpy as np
+
+from figures import LiveTrace
+
+
+def encode_block(start, idx, values, sr, max_points):
+    # compact event: first sample index, uint16 offsets from it and float32 values, both base64 encoded
+    return {'s': int(start), 'sr': sr, 'm': max_points,
+            'i': base64.b64encode(idx.astype(np.uint16).tobytes()).decode('ascii'),
+            'y': base64.b64encode(values.astype(np.float32).tobytes()).decode('ascii')}
+
+
+def sse_event(event):
+    return f'data: {json.dumps(event, separators=(",", ":"))}\n\n'
+
+
+class FramePublisher(object):
+    """
+    Computes every display frame once and fans it out to all connected viewers.
+
+    A single thread decimates the samples that arrived in the last `period` seconds with one LiveTrace and
+    adds the newest prediction text, live band powers and shared status; each frame is serialized once and
+    kept in a short history. Every /stream connection only waits for frames it has not sent yet, so more
+    viewers cost a socket write each instead of another decimation pass. A viewer that falls more than
+    `history` frames behind skips ahead to the live edge. assets/live_stream.js draws the frames with
+    Plotly.extendTraces / Plotly.restyle. With a Metrics registry, render time and display staleness (age of
+    the newest sample when it is pushed) are recorded and its summary is pushed every metrics_period seconds
+    for the optional metrics panel.
+    """
+
+    def __init__(self, d, get_prediction, get_band_powers, get_status=None, metrics=None, metrics_period=1.0,
+                 period=0.02, window=10000, sr=1000, history=256):
+        self.d = d
+        self.get_prediction = get_prediction
+        self.get_band_powers = get_band_powers
+        self.get_status = get_status or (lambda: None)
+        self.metrics = metrics
+        self.metrics_period = metrics_period
+        self.period = period
+        self.trace = LiveTrace(window=window, sr=sr)
+        self.sr = sr
+        self.frames = deque(maxlen=history)
+        self.sequence = 0
+        self.latest = {}  # newest prediction / bands / status / metrics, sent to viewers when they connect
+        self.last_bands = None
+        self.viewers = 0
+        self.condition = threading.Condition()
+        self.thread = None
+        self.stopping = threading.Event()
+
+    def start(self):
+        # idempotent, the first viewer starts the publishing thread
+        with self.condition:
+            if self.thread is None and not self.stopping.is_set():
+                self.trace.cursor = self.d.count  # start at the live edge
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def stop(self):
+        # ends the publishing thread for good, connected viewers only get keep-alives afterwards
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def frame(self, last_metrics):
+        event = {}
+        t0 = monotonic()
+        block = self.trace.update_block(self.d)
+        if block is not None:
+            event['trace'] = encode_block(*block, sr=self.sr, max_points=self.trace.max_points)
+            if self.metrics is not None:
+                self.metrics.observe('render', monotonic() - t0)
+                self.metrics.observe('display_staleness', monotonic() - self.d.last_commit)
+        prediction = self.get_prediction()
+        if prediction != self.latest.get('prediction'):
+            event['prediction'] = prediction
+        bands = self.get_band_powers()
+        if bands is not None and bands is not self.last_bands:
+            event['bands'] = [round(float(power), 3) for power in bands]
+            self.last_bands = bands
+        status = self.get_status()
+        if status != self.latest.get('status'):
+            event['status'] = status
+        if self.metrics is not None and monotonic() - last_metrics >= self.metrics_period:
+            event['metrics'] = self.metrics.summary()
+        return event
+
+    def run(self):
+        last_metrics = monotonic()
+        while not self.stopping.is_set():
+            event = self.frame(last_metrics)
+            if 'metrics' in event:
+                last_metrics = monotonic()
+            if event:
+                text = sse_event(event)
+                with self.condition:
+                    self.latest.update((key, value) for key, value in event.items() if key != 'trace')
+                    self.sequence += 1
+                    self.frames.append((self.sequence, text))
+                    self.condition.notify_all()
+            self.stopping.wait(self.period)
+
+    def stream(self, heartbeat=15.0):
+        # server-sent events for one viewer: the current state, then every new frame
+        self.start()
+        with self.condition:
+            self.viewers += 1
+            sequence = self.sequence
+            snapshot = dict(self.latest)
+        try:
+            if snapshot:
+                yield sse_event(snapshot)
+            while True:
+                with self.condition:
+                    self.condition.wait_for(lambda: self.sequence > sequence, timeout=heartbeat)
+                    frames = [(n, text) for n, text in self.frames if n > sequence]
+                if not frames:
+                    yield ': keep-alive\n\n'
+                    continue
+                sequence = frames[-1][0]
+                yield ''.join(text for _, text in frames)
+        finally:
+            with self.condition:
+                self.viewers -= 1
@@ -1,187 +1,198 @@
-from dash import Dash, dcc, html, Input, Output, callback, State
+from startup import timed_imports, import_report
+
+# the live path only; pandas, scikit-learn, matplotlib and scipy.signal are imported on first use by training
+IMPORT_TIMES = timed_imports(['dash', 'flask', 'numpy', 'figures', 'live_stream', 'metrics', 'ring_buffer',
+                              'recorder', 'analysis', 'tcp_server', 'replay', 'classifier', 'backend',
+                              'training_jobs'])
+
+from dash import Dash, dcc, html, Input, Output, State, ctx
 from figures import init_figs
-from tcp_server import tcp_client_processing
-from multiprocessing import Process, Manager, Queue
-import numpy as np
-from analysis import baseline_shift, filtered, show_psd, clc_power
-import datetime
-from joblib import load
-import pandas as pd
-from data_extraction import output_psd_txt
-from svm_training import svm_train
-
-my_global_fig, my_psd_fig = init_figs()
-realtime_flag = False
-state_flag = 0
+from flask import Response
+from backend import Backend
+from training_jobs import TrainingJobRunner
+
+CHANNELS = 1  # EEG channels in the montage, 8-32 for full caps
+SHOW_METRICS = False  # per-stage latency / throughput panel under the dash board
+REPLAY_SESSION = None  # e.g. './data/state1.npy': play a recorded session instead of connecting to OpenSignals
+REPLAY_SPEED = 1.0  # with REPLAY_SESSION, N times real time
+training_jobs = TrainingJobRunner('./cache/features')
+backend = None  # the one acquisition / classification pipeline every viewer watches, created at startup
 
 # Dash display
 app = Dash(__name__)
 
-app.layout = html.Div([
-    html.Div([
-        html.Img(src="./assets/ncl_logo.png", className='ncl-logo'),
-        html.P(["Real-time Electroencephalogram Analysis System"], className="title"),
+
+def serve_layout():
+    # called for every page load: each viewer gets its own figures and session state, the data they show
+    # comes from the shared backend over /stream
+    sample_fig, psd_fig = init_figs()
+    return html.Div([
+        dcc.Store(id='viewer-state', data={'linked': False}),  # whether this viewer is linked to the backend
+        dcc.Store(id='training-job', data=None),  # id of the training job this viewer submitted
         html.Div([
-            html.P(["George Zhao"], className="contact"),
-            html.A(["Email: j.zhao36@newcastle.ac.uk"], className="contact", href='mailto:j.zhao36@newcastle.ac.uk')
-        ])
-    ], className="app-header"),
-    html.Div([
+            html.Img(src="./assets/ncl_logo.png", className='ncl-logo'),
+            html.P(["Real-time Electroencephalogram Analysis System"], className="title"),
+            html.Div([
+                html.P(["George Zhao"], className="contact"),
+                html.A(["Email: j.zhao36@newcastle.ac.uk"], className="contact", href='mailto:j.zhao36@newcastle.ac.uk')
+            ])
+        ], className="app-header"),
         html.Div([
-            dcc.RadioItems([
-                {
-                    "label": html.Div(["Wait"], className="nav-item", id="nav-item-1"),
-                    "value": "Wait"
-                },
-                {
-                    "label": html.Div(["Link"], className="nav-item", id="nav-item-2"),
-                    "value": "Link"
-                }
-            ], id="select-model", value="Wait", inline=True, className="nav", inputClassName="nav-rad"),
-        ], style={'textAlign': 'left', 'width': '50%', 'padding-top': '20px', 'padding-left': '50px'}),
+            html.Div([
+                dcc.RadioItems([
+                    {
+                        "label": html.Div(["Wait"], className="nav-item", id="nav-item-1"),
+                        "value": "Wait"
+                    },
+                    {
+                        "label": html.Div(["Link"], className="nav-item", id="nav-item-2"),
+                        "value": "Link"
+                    }
+                ], id="select-model", value="Wait", inline=True, className="nav", inputClassName="nav-rad"),
+            ], style={'textAlign': 'left', 'width': '50%', 'padding-top': '20px', 'padding-left': '50px'}),
+            html.Div([
+                html.Button('Start', id='start-stop-button', n_clicks=0),
+
+            ], style={'textAlign': 'right', 'width': '50%', 'padding-top': '20px', 'padding-right': '50px'})
+        ], style={'display': 'flex'}),
         html.Div([
-            html.Button('Start', id='start-stop-button', n_clicks=0),
-
-        ], style={'textAlign': 'right', 'width': '50%', 'padding-top': '20px', 'padding-right': '50px'})
-    ], style={'display': 'flex'}),
-    html.Div([
-        html.Div([dcc.Graph(id='sample-graph', figure=my_global_fig)], className="global-graph-graph"),
-        dcc.Interval(id='interval-component', interval=1 * 1000, n_intervals=0, disabled=True),
-    ]),
-    html.Div([
+            html.Div([dcc.Graph(id='sample-graph', figure=sample_fig)], className="global-graph-graph"),
+            html.Div([dcc.Graph(id='psd-graph', figure=psd_fig)], className="global-graph-graph"),
+        ]),
         html.Div([
             html.Div([
-                html.Button('State 1', id='state1-button', n_clicks=0),
-                html.Button('State 0', id='state2-button', n_clicks=0),
-                html.Button('Exit', id='exit-button', n_clicks=0),
-                html.Button('Train', id='train-button', n_clicks=0),
-                html.Div([''], id='cvt-state'),
-            ], className='dash-board-text'),
-        ], className='dash-board-frame'),
-    ], className='dash-board')
-])
+                html.Div([
+                    html.Button('State 1', id='state1-button', n_clicks=0),
+                    html.Button('State 0', id='state2-button', n_clicks=0),
+                    html.Button('Exit', id='exit-button', n_clicks=0),
+                    html.Button('Train', id='train-button', n_clicks=0),
+                    html.Button('Update', id='update-button', n_clicks=0),
+                    html.Button('Cancel', id='cancel-button', n_clicks=0),
+                    html.Div([''], id='cvt-state'),
+                    dcc.Interval(id='train-poll', interval=500, n_intervals=0, disabled=True),
+                    html.Div([''], id='prediction-state'),
+                    html.Div([''], id='shared-state'),
+                ], className='dash-board-text'),
+            ], className='dash-board-frame'),
+        ], className='dash-board'),
+        html.Pre([''], id='metrics-panel') if SHOW_METRICS else html.Div(),
+    ])
+
+
+app.layout = serve_layout
 
 
 # Callback functions
 # for choosing the data analyse mode
 @app.callback(
     Output('cvt-state', 'children'),
+    Output('train-poll', 'disabled'),
+    Output('training-job', 'data'),
     Input('train-button', 'n_clicks'),
+    Input('update-button', 'n_clicks'),
+    Input('cancel-button', 'n_clicks'),
+    Input('train-poll', 'n_intervals'),
+    State('training-job', 'data'),
 )
-def training_model(click):
-    if click>0:
-        output_psd_txt('./data/state1.txt')
-        output_psd_txt('./data/state2.txt')
-
-        return svm_train()
-    return f'0'
-
+def training_model(click, update_click, cancel_click, n, training_job_id):
+    # training runs in its own process, this callback only submits, polls and cancels it; find_recordings is
+    # imported only when a job is submitted, it pulls in pandas and scipy.signal
+    if ctx.triggered_id == 'train-button' and click > 0:
+        from data_extraction import find_recordings
+        # every labelled session in ./data, only new or changed recordings are extracted (in parallel);
+        # fast recalibration: parallel successive-halving search, plots are skipped, NumPy-only model exported
+        training_job_id = training_jobs.submit(find_recordings('./data'),
+                                               search='halving', n_jobs=-1, diagnostics=False, export=True)
+    elif ctx.triggered_id == 'update-button' and update_click > 0:
+        from data_extraction import find_recordings
+        # mid-session recalibration: the windows recorded since the last training are folded into the model
+        training_job_id = training_jobs.submit(find_recordings('./data'), mode='update')
+    elif ctx.triggered_id == 'cancel-button' and training_job_id is not None:
+        training_jobs.cancel(training_job_id)
+    if training_job_id is None:
+        return f'0', True, None
+    job = training_jobs.poll(training_job_id)
+    return job.describe(), job.status != 'running', training_job_id
 
 
 @app.callback(
     Output('nav-item-1', 'style'),
     Output('nav-item-2', 'style'),
-    Output('interval-component', 'disabled'),
+    Output('viewer-state', 'data'),
     Input('select-model', 'value'),
 )
 def update_model(value):
-    global realtime_flag
     if value == "Link":
-        realtime_flag = True
-        # processing for tcp/ip function
-        tcp_processing.start()
-        return {'background-color': 'white', 'color': 'black'}, {'background-color': '#163a6c', 'color': 'white'}, False
-    if value == "Wait":
-        if realtime_flag:
-            realtime_flag = False
-            tcp_processing.join()
-        return {'background-color': '#163a6c', 'color': 'white'}, {'background-color': 'white', 'color': 'black'}, True
+        # the first viewer to link starts acquisition and online classification, the others join the stream
+        backend.start()
+        return ({'background-color': 'white', 'color': 'black'}, {'background-color': '#163a6c', 'color': 'white'},
+                {'linked': True})
+    # Wait only unlinks this viewer, the backend keeps serving the others until Exit
+    return ({'background-color': '#163a6c', 'color': 'white'}, {'background-color': 'white', 'color': 'black'},
+            {'linked': False})
 
 
+# State buttons toggle the shared recording: the same button stops it, the other one switches its label
 @app.callback(
     Output('state1-button', 'n_clicks'),
     Output('exit-button', 'n_clicks'),
     Input('state1-button', 'n_clicks'),
     Input('exit-button', 'n_clicks'),
-    Input('select-model', 'value'),
+    State('viewer-state', 'data'),
 )
-def button_clicked(state1_clicks, exit_clicks, value):
-    global state_flag
-    if value == "Link":
-        if not exit_clicks > 0:
-            if state1_clicks > 0:
-                if state1_clicks % 2 == 0:
-                    q.put('1')  # stop
-                    state_flag = 0
-                else:
-                    state_flag = 1
-                    q.put('0')  # start
-        else:
-            q.put('2')
-            tcp_processing.join()
+def button_clicked(state1_clicks, exit_clicks, viewer):
+    if viewer and viewer['linked']:
+        if ctx.triggered_id == 'state1-button' and state1_clicks > 0:
+            backend.toggle_recording(1)
+        elif ctx.triggered_id == 'exit-button' and exit_clicks > 0:
+            backend.exit()
     return state1_clicks, exit_clicks
 
 
 @app.callback(
     Output('state2-button', 'n_clicks'),
     Input('state2-button', 'n_clicks'),
-    Input('exit-button', 'n_clicks'),
-    Input('select-model', 'value'),
+    State('viewer-state', 'data'),
 )
-def button_clicked1(state2_clicks, exit_clicks, value):
-    global state_flag
-    if value == "Link":
-        if not exit_clicks > 0:
-            if state2_clicks > 0:
-                if state2_clicks % 2 == 0:
-                    q.put('1')  # stop
-                    state_flag = 0
-                else:
-                    q.put('0')  # start
-                    state_flag = 2
-        else:
-            q.put('2')
-            tcp_processing.join()
+def button_clicked1(state2_clicks, viewer):
+    if viewer and viewer['linked'] and state2_clicks > 0:
+        backend.toggle_recording(2)
     return state2_clicks
 
 
-@callback(
-    Output('sample-graph', 'figure'),
-    Input('interval-component', 'n_intervals'),
-    Input('select-model', 'value'),
-)
-def update_metrics(n, value):
-    data_list = list(d)
-    if value == "Link" and data_list:
-        array_length = 10000
-        my_global_fig.update_traces(
-            x=np.linspace(0, 11, array_length),
-            y=data_list,
-        )
-        len_datalist = len(data_list)
-        if len_datalist > 9999:
-            bs_data = data_list[8*1000:9*1000]
-            if state_flag == 1:
-                with open('./data/state1.txt', 'a') as file1:
-                    file1.write(str(bs_data))
-            elif state_flag == 2:
-                with open('./data/state2.txt', 'a') as file1:
-                    file1.write(str(bs_data))
-    return my_global_fig
+# live samples, predictions and the shared status are computed once and pushed to every browser
+# (assets/live_stream.js) instead of polled
+@app.server.route('/stream')
+def stream():
+    return Response(backend.stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+# per-stage latency histograms, counters and gauges of every process, for Prometheus or ad hoc inspection
+@app.server.route('/metrics')
+def metrics_text():
+    backend.metrics.collect(backend.m)
+    return Response(backend.metrics.to_prometheus(), mimetype='text/plain; version=0.0.4')
+
+
+@app.server.route('/metrics.json')
+def metrics_json():
+    backend.metrics.collect(backend.m)
+    return Response(backend.metrics.to_json(), mimetype='application/json')
 
 
 # Press the green button in the gutter to run the script.
 if __name__ == '__main__':
-    # with open('./data/state1.txt', 'w') as files1:
-    #     pass
-    # with open('./data/state2.txt', 'w') as files2:
-    #     pass
-    # shared variables between dash app and tcp/ip server
-    with Manager() as manager:
-        d = Manager().list()  # raw datas
-        q = Queue()  # control signal
-    tcp_processing = Process(target=tcp_client_processing, args=(d, q))
-    # dash app run
-    app.run(debug=True)
+    print(import_report(IMPORT_TIMES))
+    # shared by every viewer: ring buffer, queues, acquisition and classifier processes, recording state
+    backend = Backend(channels=CHANNELS, replay_session=REPLAY_SESSION, replay_speed=REPLAY_SPEED,
+                      show_metrics=SHOW_METRICS)
+    for name, seconds in IMPORT_TIMES:
+        backend.metrics.set(f'import_{name}_s', seconds)
+    # dash app run, the ring buffer's shared memory is freed when the server stops
+    try:
+        app.run(debug=True)
+    finally:
+        backend.close()
 
 # See PyCharm help at https://www.jetbrains.com/help/pycharm/
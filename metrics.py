@@ -0,0 +1,130 @@
+import json
+import queue
+from bisect import bisect_left
+from time import monotonic
+
+# latency histogram bucket upper bounds: 10 us .. ~20 s, four buckets per octave
+BUCKETS = tuple(1e-5 * 2 ** (k / 4) for k in range(85))
+
+
+class Histogram(object):
+    # fixed log-spaced buckets, observe() is one bisect and two additions
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def snapshot(self):
+        return {'counts': list(self.counts), 'count': self.count, 'sum': self.sum}
+
+
+def quantile(snapshot, q):
+    # upper bucket bound containing the q-th observation
+    if not snapshot['count']:
+        return None
+    rank = q * snapshot['count']
+    seen = 0
+    for bound, n in zip(BUCKETS + (float('inf'),), snapshot['counts']):
+        seen += n
+        if seen >= rank:
+            return bound
+    return float('inf')
+
+
+class Metrics(object):
+    """
+    Per-process registry of stage histograms, counters and gauges.
+
+    Child processes publish their snapshot to a shared queue with publish(); the dash process merges them
+    with collect() and serves the result as JSON or Prometheus text.
+    """
+
+    def __init__(self, process_name):
+        self.process_name = process_name
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self.remote = {}
+        self.last_publish = 0.0
+
+    def histogram(self, name):
+        if name not in self.histograms:
+            self.histograms[name] = Histogram()
+        return self.histograms[name]
+
+    def observe(self, name, seconds):
+        self.histogram(name).observe(seconds)
+
+    def inc(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name, value):
+        self.gauges[name] = value
+
+    def snapshot(self):
+        return {'histograms': {name: h.snapshot() for name, h in self.histograms.items()},
+                'counters': dict(self.counters), 'gauges': dict(self.gauges)}
+
+    def publish(self, m, period=1.0):
+        # at most once per period, never blocks the caller
+        if m is None or monotonic() - self.last_publish < period:
+            return
+        self.last_publish = monotonic()
+        try:
+            m.put_nowait((self.process_name, self.snapshot()))
+        except queue.Full:
+            pass
+
+    def collect(self, m):
+        # merge the newest snapshots published by other processes
+        try:
+            while True:
+                process_name, snapshot = m.get_nowait()
+                self.remote[process_name] = snapshot
+        except queue.Empty:
+            pass
+
+    def all_snapshots(self):
+        snapshots = dict(self.remote)
+        snapshots[self.process_name] = self.snapshot()
+        return snapshots
+
+    def to_json(self):
+        return json.dumps(self.all_snapshots())
+
+    def to_prometheus(self):
+        lines = []
+        for process_name, snapshot in sorted(self.all_snapshots().items()):
+            label = f'process="{process_name}"'
+            for name, value in sorted(snapshot['counters'].items()):
+                lines.append(f'bci_{name}_total{{{label}}} {value}')
+            for name, value in sorted(snapshot['gauges'].items()):
+                lines.append(f'bci_{name}{{{label}}} {value}')
+            for name, h in sorted(snapshot['histograms'].items()):
+                cumulative = 0
+                for bound, n in zip(BUCKETS, h['counts']):
+                    cumulative += n
+                    lines.append(f'bci_{name}_seconds_bucket{{{label},le="{bound:.6g}"}} {cumulative}')
+                lines.append(f'bci_{name}_seconds_bucket{{{label},le="+Inf"}} {h["count"]}')
+                lines.append(f'bci_{name}_seconds_sum{{{label}}} {h["sum"]}')
+                lines.append(f'bci_{name}_seconds_count{{{label}}} {h["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        # short text for the dashboard panel: p50 / p99 per stage, then counters and gauges
+        lines = []
+        for process_name, snapshot in sorted(self.all_snapshots().items()):
+            for name, h in sorted(snapshot['histograms'].items()):
+                if h['count']:
+                    lines.append(f'{process_name}.{name}: p50 {quantile(h, 0.5) * 1000:.2f} ms, '
+                                 f'p99 {quantile(h, 0.99) * 1000:.2f} ms, n={h["count"]}')
+            for name, value in sorted({**snapshot['counters'], **snapshot['gauges']}.items()):
+                lines.append(f'{process_name}.{name}: {value:.3g}' if isinstance(value, float)
+                             else f'{process_name}.{name}: {value}')
+        return '\n'.join(lines)
+
@@ -0,0 +1,99 @@
+import json
+import os
+import struct
+import time
+import numpy as np
+
+# fixed-size .npy (format 1.0) header, rewritten in place after every append so the file stays loadable
+_MAGIC = b'\x93NUMPY\x01\x00'
+_HEADER_BYTES = 128
+
+
+def _npy_header(dtype, shape):
+    header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (np.dtype(dtype).str, tuple(shape))
+    header = header.ljust(_HEADER_BYTES - len(_MAGIC) - 2 - 1) + '\n'
+    return _MAGIC + struct.pack('<H', len(header)) + header.encode('latin1')
+
+
+def replace_file(path, write):
+    # write(file) fills a binary file next to path, which then replaces path in one rename, so readers never see
+    # a half-written file; data that must stay consistent has to live in a single file
+    with open(path + '.tmp', 'wb') as file:
+        write(file)
+    os.replace(path + '.tmp', path)
+
+
+def create_npy(file_path, dtype, row_shape=()):
+    # empty .npy file that append_npy can grow in place
+    with open(file_path, 'wb') as file:
+        file.write(_npy_header(dtype, (0,) + tuple(row_shape)))
+
+
+def append_npy(file_path, rows, dtype, row_shape=(), start=None):
+    # appends (n, *row_shape) rows to a file made by create_npy and rewrites its header, returns the row count;
+    # with start the rows are written from row start on and anything after it (e.g. rows of an interrupted
+    # append that an index never recorded) is discarded
+    rows = np.ascontiguousarray(rows, dtype=dtype)
+    row_bytes = np.dtype(dtype).itemsize * int(np.prod(row_shape))
+    with open(file_path, 'r+b') as file:
+        end = file.seek(0, os.SEEK_END)
+        if start is not None:
+            if end < _HEADER_BYTES + start * row_bytes:
+                raise ValueError(f'{file_path} holds fewer than {start} rows')
+            file.truncate(_HEADER_BYTES + start * row_bytes)
+            file.seek(_HEADER_BYTES + start * row_bytes)
+        file.write(rows.tobytes())
+        n = (file.tell() - _HEADER_BYTES) // row_bytes
+        file.seek(0)
+        file.write(_npy_header(dtype, (n,) + tuple(row_shape)))
+    return n
+
+
+def info_path(file_path):
+    return os.path.splitext(file_path)[0] + '.json'
+
+
+class SessionRecorder(object):
+    """
+    Appends raw samples to a typed binary session file.
+
+    The data file is a plain .npy array of shape (samples,) or (samples, channels) that np.load can memory-map;
+    sample rate, channel count, label and start timestamp go to a .json file next to it. Recording into an
+    existing session keeps appending to it.
+    """
+
+    def __init__(self, file_path, sr=1000, channels=1, label=None, dtype=np.float32):
+        self.file_path = file_path
+        self.channels = channels
+        self.dtype = np.dtype(dtype)
+        if os.path.exists(file_path):
+            info = session_info(file_path)
+            self.channels = info['channels']
+            self.dtype = np.dtype(info['dtype'])
+        else:
+            os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+            create_npy(file_path, self.dtype, self._row_shape())
+            with open(info_path(file_path), 'w') as file:
+                json.dump({'sample_rate': sr, 'channels': channels, 'label': label,
+                           'start_timestamp': time.time(), 'dtype': self.dtype.str}, file)
+
+    def _row_shape(self):
+        return () if self.channels == 1 else (self.channels,)
+
+    def append(self, samples):
+        if np.size(samples) == 0:
+            return
+        append_npy(self.file_path, samples, self.dtype, self._row_shape())
+
+    def __len__(self):
+        return (os.path.getsize(self.file_path) - _HEADER_BYTES) // (self.dtype.itemsize * self.channels)
+
+
+def session_info(file_path):
+    with open(info_path(file_path), 'r') as file:
+        return json.load(file)
+
+
+def load_session(file_path):
+    # read-only memory-mapped view of a recorded session
+    return np.load(file_path, mmap_mode='r')
@@ -0,0 +1,175 @@
+import argparse
+import os
+import queue
+from time import monotonic, perf_counter, sleep
+
+import numpy as np
+
+from classifier import OnlineClassifier
+from metrics import Metrics
+from recorder import info_path, load_session, session_info
+from ring_buffer import RingBuffer
+
+
+class SessionReplay(object):
+    """
+    Streams a recorded session into a RingBuffer like the acquisition process does.
+
+    Samples are written in blocks of block samples. speed=1 paces the blocks in real time, speed=N N times
+    faster and speed=None writes them as fast as the pipeline takes them. Sample times come from the session
+    itself (start_timestamp + index / sr), never from the wall clock, so a replay gives the same samples,
+    windows and predictions at any speed.
+    """
+
+    def __init__(self, file_path, d, speed=1.0, block=50, sr=None):
+        self.file_path = file_path
+        self.d = d
+        self.samples = load_session(file_path)  # memory-mapped, hours of data are not loaded at once
+        info = session_info(file_path) if os.path.exists(info_path(file_path)) else {}
+        self.sr = sr or info.get('sample_rate', 1000)
+        self.label = info.get('label')
+        self.start_timestamp = info.get('start_timestamp', 0.0)
+        self.speed = speed
+        self.block = block
+        self.position = 0
+
+    def __len__(self):
+        return len(self.samples)
+
+    def timestamp(self, position):
+        # session time of the sample at position (samples from the start of the file)
+        return self.start_timestamp + position / self.sr
+
+    def step(self, t_start=None):
+        # writes the next block, waiting for its due time when paced; returns the new position, None at the end
+        if self.position >= len(self.samples):
+            return None
+        stop = min(self.position + self.block, len(self.samples))
+        if self.speed and t_start is not None:
+            delay = t_start + stop / self.sr / self.speed - monotonic()
+            if delay > 0:
+                sleep(delay)
+        self.d.extend(np.asarray(self.samples[self.position:stop], dtype=np.float64))
+        self.position = stop
+        return stop
+
+    def rewind(self):
+        self.position = 0
+
+
+def replay_processing(d, q, file_path, speed=1.0, block=50, loop=False, m=None):
+    """
+    Drop-in for tcp_client_processing that plays a recorded session instead of reading OpenSignals.
+
+    Uses the same command queue: '0' plays, '1' pauses, '2' exits. With loop the session restarts at its end,
+    otherwise the replay stops there.
+    """
+    replay = SessionReplay(file_path, d, speed=speed, block=block)
+    metrics = Metrics('acquisition')
+    playing = False
+    t_start = None
+    while True:
+        metrics.publish(m)
+        try:
+            user_action = str(q.get_nowait() if playing else q.get())  # blocks while paused
+        except queue.Empty:
+            user_action = None
+        if user_action == '0':
+            playing = True
+            t_start = monotonic() - replay.position / replay.sr / (speed or 1)
+        elif user_action == '1':
+            playing = False
+        elif user_action == '2':
+            break
+        if not playing:
+            continue
+        t0 = perf_counter()
+        previous = replay.position
+        position = replay.step(t_start)
+        if position is None:
+            if not loop:
+                playing = False
+                continue
+            replay.rewind()
+            t_start = monotonic()
+            continue
+        metrics.observe('commit', perf_counter() - t0)
+        metrics.inc('samples_ingested', position - previous)
+
+
+def replay_session(file_path, speed=None, hop=0.05, predict=True):
+    """
+    Replays one session through the ring buffer and the online classifier in this process.
+
+    After every hop seconds of session time the newest window is classified exactly like classifier_processing
+    does, so the predictions are deterministic and independent of speed. Returns a dict with the per-window
+    predictions as (session time, ring buffer count, prediction) rows, the accuracy against the session
+    label, the feature / predict / commit latency summary and how much faster than real time the replay ran.
+    """
+    info = session_info(file_path) if os.path.exists(info_path(file_path)) else {}
+    sr = info.get('sample_rate', 1000)
+    samples = load_session(file_path)
+    d = RingBuffer(max(10000, 10 * sr), channels=1 if samples.ndim == 1 else samples.shape[1])
+    replay = SessionReplay(file_path, d, speed=speed, block=int(round(hop * sr)), sr=sr)
+    engine = OnlineClassifier(d, sr=sr)
+    predict = predict and engine.load()
+    metrics = Metrics('replay')
+    predictions = []
+    t_start = monotonic()
+    try:
+        while True:
+            t0 = perf_counter()
+            position = replay.step(t_start)
+            if position is None:
+                break
+            t_commit = perf_counter()
+            metrics.observe('commit', t_commit - t0)
+            if not predict or d.count < engine.win:
+                continue
+            features = engine.features()
+            t_features = perf_counter()
+            prediction = engine.predict(features)
+            t_predicted = perf_counter()
+            metrics.observe('feature', t_features - t_commit)
+            metrics.observe('predict', t_predicted - t_features)
+            metrics.observe('sample_to_prediction', t_predicted - t0)
+            predictions.append((replay.timestamp(position), d.count, prediction))
+    finally:
+        d.close()
+    elapsed = monotonic() - t_start
+    predictions = np.array(predictions, dtype=np.float64).reshape(-1, 3)
+    accuracy = None
+    if predictions.size and replay.label is not None:
+        accuracy = float(np.mean(predictions[:, 2] == replay.label))
+    return {
+        'session': file_path,
+        'samples': len(replay),
+        'elapsed_s': elapsed,
+        'realtime_factor': len(replay) / sr / elapsed if elapsed else float('inf'),
+        'windows': len(predictions),
+        'accuracy': accuracy,
+        'predictions': predictions,
+        'latency': metrics.summary(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay recorded sessions through the online pipeline')
+    parser.add_argument('sessions', nargs='+', help='.npy sessions recorded by SessionRecorder')
+    parser.add_argument('--speed', type=float, default=0, help='1 = real time, N = N times faster, 0 = unthrottled')
+    parser.add_argument('--hop', type=float, default=0.05)
+    parser.add_argument('--no-predict', action='store_true')
+    parser.add_argument('--save', help='write every session\'s predictions to this .npz')
+    args = parser.parse_args()
+    results = [replay_session(path, speed=args.speed or None, hop=args.hop, predict=not args.no_predict)
+               for path in args.sessions]
+    for result in results:
+        print(f"{result['session']}: {result['samples']} samples, {result['windows']} windows in "
+              f"{result['elapsed_s']:.2f}s ({result['realtime_factor']:.0f}x real time), accuracy {result['accuracy']}")
+        print(result['latency'])
+    if args.save:
+        np.savez(args.save, **{f'session{k}': result['predictions'] for k, result in enumerate(results)})
+
+
+if __name__ == '__main__':
+    main()
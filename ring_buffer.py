@@ -0,0 +1,142 @@
+from multiprocessing import shared_memory
+from time import monotonic_ns
+import numpy as np
+
+# header layout (int64 slots)
+_WRITE_CURSOR = 0  # total number of samples ever written
+_SEQUENCE = 1  # odd while a write is in progress, even when the buffer is consistent
+_CAPACITY = 2
+_CHANNELS = 3
+_COMMIT_NS = 4  # time.monotonic_ns() of the newest block, comparable across processes
+_HEADER_SLOTS = 8
+_HEADER_BYTES = _HEADER_SLOTS * 8
+
+
+class RingBuffer(object):
+    """
+    Single-producer / multi-consumer sample buffer backed by multiprocessing.shared_memory.
+
+    The data region is (channels, 2 * capacity) and every sample is written to both halves, so the latest N
+    samples are always one contiguous slice and readers get them as a zero-copy NumPy view, shaped (N,) for a
+    single channel and (channels, N) otherwise. The write
+    cursor and sequence counter live in the shared header: the producer bumps the sequence to an odd
+    value before writing and back to even afterwards, readers use it to detect torn reads.
+    """
+
+    def __init__(self, capacity=10000, channels=1, name=None, create=True, dtype=np.float64):
+        self.dtype = np.dtype(dtype)
+        if create:
+            size = _HEADER_BYTES + 2 * capacity * channels * self.dtype.itemsize
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.owner = create
+        self._attach((capacity, channels) if create else None)
+
+    def _attach(self, shape):
+        self.header = np.ndarray((_HEADER_SLOTS,), dtype=np.int64, buffer=self.shm.buf)
+        if shape is not None:
+            self.header[:] = 0
+            self.header[_CAPACITY], self.header[_CHANNELS] = shape
+        self.capacity = int(self.header[_CAPACITY])
+        self.channels = int(self.header[_CHANNELS])
+        self.data = np.ndarray((self.channels, 2 * self.capacity), dtype=self.dtype, buffer=self.shm.buf,
+                               offset=_HEADER_BYTES)
+        if shape is not None:
+            self.data[:] = 0
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    @property
+    def count(self):
+        return int(self.header[_WRITE_CURSOR])
+
+    @property
+    def last_commit(self):
+        # time.monotonic() of the newest write, None before the first one
+        commit_ns = int(self.header[_COMMIT_NS])
+        return commit_ns / 1e9 if commit_ns else None
+
+    @property
+    def sequence(self):
+        return int(self.header[_SEQUENCE])
+
+    # the buffer is handed to the acquisition process by name, the child attaches to the same block
+    def __getstate__(self):
+        return {'name': self.shm.name, 'dtype': self.dtype.str}
+
+    def __setstate__(self, state):
+        self.dtype = np.dtype(state['dtype'])
+        self.shm = shared_memory.SharedMemory(name=state['name'])
+        self.owner = False
+        self._attach(None)
+
+    def append(self, sample):
+        self.extend((sample,))
+
+    def extend(self, samples):
+        # producer side, must only be called from one process; samples are (n,) or (n, channels) rows
+        samples = np.asarray(samples, dtype=self.dtype).reshape(-1, self.channels).T
+        total = samples.shape[1]
+        if total == 0:
+            return
+        if total > self.capacity:
+            samples = samples[:, -self.capacity:]
+        n = samples.shape[1]
+        cursor = int(self.header[_WRITE_CURSOR])
+        start = (cursor + total - n) % self.capacity
+
+        self.header[_SEQUENCE] += 1
+        first = min(n, self.capacity - start)
+        for offset in (0, self.capacity):
+            self.data[:, offset + start:offset + start + first] = samples[:, :first]
+            self.data[:, offset:offset + n - first] = samples[:, first:]
+        self.header[_WRITE_CURSOR] = cursor + total
+        self.header[_COMMIT_NS] = monotonic_ns()
+        self.header[_SEQUENCE] += 1
+
+    def latest(self, n=None):
+        # zero-copy view of the newest n samples, oldest first (zero padded until the buffer fills up)
+        if n is None or n > self.capacity:
+            n = self.capacity
+        end = int(self.header[_WRITE_CURSOR]) % self.capacity + self.capacity
+        window = self.data[:, end - n:end]
+        return window[0] if self.channels == 1 else window
+
+    def snapshot(self, n=None, retries=10):
+        # consistent copy of the newest n samples, retried while the producer is mid-write
+        for _ in range(retries):
+            seq = int(self.header[_SEQUENCE])
+            if seq % 2:
+                continue
+            out = self.latest(n).copy()
+            if int(self.header[_SEQUENCE]) == seq:
+                return out
+        return self.latest(n).copy()
+
+    def read_since(self, cursor, n_max=None):
+        # samples written after `cursor` (a previous value of `count`) and the new cursor
+        n_max = self.capacity if n_max is None else min(n_max, self.capacity)
+        for _ in range(10):
+            seq = int(self.header[_SEQUENCE])
+            if seq % 2:
+                continue
+            count = int(self.header[_WRITE_CURSOR])
+            n = min(count - cursor, n_max)
+            out = self.latest(max(n, 0)).copy()
+            if int(self.header[_SEQUENCE]) == seq:
+                return out, count
+        count = int(self.header[_WRITE_CURSOR])
+        n = min(count - cursor, n_max)
+        return self.latest(max(n, 0)).copy(), count
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def close(self):
+        del self.header, self.data
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
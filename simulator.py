@@ -0,0 +1,134 @@
+import argparse
+import json
+import socket
+import threading
+from time import monotonic, sleep
+
+import numpy as np
+
+
+class OpenSignalsSimulator(object):
+    """
+    Local stand-in for the OpenSignals TCP server.
+
+    Speaks the same protocol as the real software: waits for 'start' / 'stop' commands and streams
+    {"returnData": {device: [[nSeq, ch1, ..., chN], ...]}} JSON frames of frame_size samples at sr Hz.
+    jitter (s, standard deviation) delays individual sends and burst glues that many frames into one send, so
+    clients see split and coalesced documents like on a busy acquisition box. Every send is logged as
+    (samples sent so far per device, monotonic send time) for latency measurements.
+    """
+
+    def __init__(self, host='127.0.0.1', port=5555, sr=1000, channels=1, frame_size=100, jitter=0.0, burst=1,
+                 devices=1, seed=0):
+        self.host = host
+        self.port = port
+        self.sr = sr
+        self.channels = channels
+        self.frame_size = frame_size
+        self.jitter = jitter
+        self.burst = burst
+        self.devices = devices
+        self.rng = np.random.default_rng(seed)
+
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.isRunning = False
+        self.isStreaming = False
+        self.sent_samples = 0
+        self.send_log = []
+
+    def start(self):
+        self.server.bind((self.host, self.port))
+        self.server.listen(1)
+        self.isRunning = True
+        thread = threading.Thread(target=self.serve)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.isRunning = False
+        self.isStreaming = False
+        self.server.close()
+
+    def serve(self):
+        while self.isRunning:
+            try:
+                client, _ = self.server.accept()
+            except OSError:
+                break
+            sender = threading.Thread(target=self.stream_frames, args=(client,))
+            sender.daemon = True
+            sender.start()
+            self.read_commands(client)
+            self.isStreaming = False
+            client.close()
+
+    def read_commands(self, client):
+        while self.isRunning:
+            try:
+                command = client.recv(1024)
+            except OSError:
+                return
+            if not command:
+                return
+            if b'start' in command:
+                self.isStreaming = True
+            elif b'stop' in command:
+                self.isStreaming = False
+
+    def make_frame(self):
+        # sine + noise integer codes on every channel, nSeq first like OpenSignals
+        n = self.frame_size
+        seq = np.arange(self.sent_samples, self.sent_samples + n)
+        t = seq / self.sr
+        signal = 40 * np.sin(2 * np.pi * 10 * t)[:, None] + self.rng.normal(0, 10, (n, self.channels))
+        rows = np.column_stack((seq % 4096, np.rint(signal))).astype(int).tolist()
+        self.sent_samples += n
+        return {"returnData": {f"00:07:80:0F:30:{k:02d}": rows for k in range(self.devices)}}
+
+    def stream_frames(self, client):
+        period = self.burst * self.frame_size / self.sr
+        next_send = monotonic()
+        while self.isRunning:
+            if not self.isStreaming:
+                sleep(0.01)
+                next_send = monotonic()
+                continue
+            payload = ''.join(json.dumps(self.make_frame()) for _ in range(self.burst)).encode()
+            delay = next_send - monotonic()
+            if self.jitter:
+                delay += abs(self.rng.normal(0, self.jitter))
+            if delay > 0:
+                sleep(delay)
+            try:
+                client.sendall(payload)
+            except OSError:
+                return
+            self.send_log.append((self.sent_samples, monotonic()))
+            next_send += period
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Synthetic OpenSignals TCP server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5555)
+    parser.add_argument('--sr', type=int, default=1000)
+    parser.add_argument('--channels', type=int, default=1)
+    parser.add_argument('--frame-size', type=int, default=100)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--burst', type=int, default=1)
+    parser.add_argument('--devices', type=int, default=1)
+    args = parser.parse_args()
+    simulator = OpenSignalsSimulator(args.host, args.port, args.sr, args.channels, args.frame_size, args.jitter,
+                                     args.burst, args.devices)
+    simulator.start()
+    print(f'OpenSignals simulator on {args.host}:{args.port}, Ctrl+C to stop')
+    try:
+        while True:
+            sleep(1)
+    except KeyboardInterrupt:
+        simulator.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+import importlib
+import sys
+from time import perf_counter
+
+# the training / diagnostics stack; the live path (dashboard, acquisition, online classifier) loads none of it
+TRAINING_MODULES = ('pandas', 'sklearn', 'matplotlib', 'scipy.signal', 'joblib')
+
+
+def timed_imports(modules):
+    """
+    Imports the modules in order and returns [(module, seconds)].
+
+    A dependency shared by several modules is charged to the first one that imports it, so the sum is the
+    total import time and the order shows where it goes.
+    """
+    times = []
+    for name in modules:
+        t0 = perf_counter()
+        importlib.import_module(name)
+        times.append((name, perf_counter() - t0))
+    return times
+
+
+def import_report(times):
+    total = sum(seconds for _, seconds in times)
+    lines = [f'imports {total:.2f}s: ' + ', '.join(f'{name} {seconds:.3f}s' for name, seconds in times)]
+    loaded = [name for name in TRAINING_MODULES if name in sys.modules]
+    if loaded:
+        lines.append('training modules loaded at startup: ' + ', '.join(loaded))
+    return '\n'.join(lines)
+
+
+def main():
+    # python startup.py: time a cold import of the dashboard
+    t0 = perf_counter()
+    main_module = importlib.import_module('main')
+    print(import_report(main_module.IMPORT_TIMES))
+    print(f'import main {perf_counter() - t0:.2f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+import codecs
+import json
+import re
+import numpy as np
+
+_NUMBER_PART = re.compile(r'[-+.eE0-9]+')
+
+
+class FrameDecoder(object):
+    """
+    Reassembles OpenSignals JSON documents from a TCP byte stream.
+
+    A single recv() may hold part of a document, exactly one, or several glued together, so bytes are
+    buffered until a complete document can be parsed and any trailing partial document is kept for the
+    next feed(). Text that can never become a document is dropped up to the next '{' and counted in
+    decode_errors, so one corrupt frame costs only itself.
+    """
+
+    def __init__(self, max_pending=1 << 22):
+        self.max_pending = max_pending  # give up on a frame that never closes
+        self._utf8 = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self._json = json.JSONDecoder()
+        self._pending = ''
+        self.decode_errors = 0
+
+    @staticmethod
+    def _truncated(text, err):
+        # True when more bytes could still complete the document, False when it is malformed
+        tail = text[err.pos:]
+        return (not tail or err.msg.startswith('Unterminated string')
+                or any(word.startswith(tail) for word in ('true', 'false', 'null'))
+                or _NUMBER_PART.fullmatch(tail) is not None)
+
+    def reset(self):
+        self._utf8.reset()
+        self._pending = ''
+
+    def feed(self, data):
+        # returns the list of complete documents found so far
+        self._pending += self._utf8.decode(data)
+        frames = []
+        pos, end = 0, len(self._pending)
+        while pos < end:
+            while pos < end and self._pending[pos].isspace():
+                pos += 1
+            if pos == end:
+                break
+            try:
+                frame, pos = self._json.raw_decode(self._pending, pos)
+            except json.JSONDecodeError as err:
+                if self._truncated(self._pending, err):
+                    break  # incomplete document, wait for more bytes
+                # malformed, resynchronise on the next document start after the error
+                self.decode_errors += 1
+                pos = self._pending.find('{', max(err.pos, pos + 1))
+                pos = end if pos < 0 else pos
+                continue
+            frames.append(frame)
+        self._pending = self._pending[pos:]
+        if len(self._pending) > self.max_pending:
+            self.decode_errors += 1
+            self._pending = ''
+        return frames
+
+
+def decode_block(frame, channels=1):
+    """
+    All samples of one frame as a single array.
+
+    channels=1: the last column of every device, devices one after another in arrival order (n,)
+    channels>1: the data columns (everything after nSeq) of all devices side by side, keeping the last
+    `channels` of them, as (n, channels) rows
+    Raises ValueError for a frame whose rows are not nSeq plus data columns, or that has fewer than `channels`
+    data columns; it is dropped as a decode error rather than written to the buffer misaligned.
+    """
+    devices = frame.get("returnData") if isinstance(frame, dict) else None
+    if not isinstance(devices, dict):
+        return np.empty((0,) if channels == 1 else (0, channels), dtype=np.float64)  # command replies carry no samples
+    blocks = [np.asarray(rows, dtype=np.float64) for rows in devices.values() if len(rows)]
+    if any(block.ndim != 2 or block.shape[1] < 2 for block in blocks):
+        raise ValueError('device rows must hold nSeq and at least one data column')
+    if channels == 1:
+        if not blocks:
+            return np.empty(0, dtype=np.float64)
+        return np.concatenate([block[:, -1] for block in blocks])
+    if not blocks:
+        return np.empty((0, channels), dtype=np.float64)
+    n = min(len(block) for block in blocks)
+    block = np.hstack([block[:n, 1:] for block in blocks])
+    if block.shape[1] < channels:
+        raise ValueError(f'frame has {block.shape[1]} data columns, {channels} channels expected')
+    return block[:, -channels:]
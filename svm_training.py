@@ -6,25 +6,170 @@ from sklearn.model_selection import train_test_split  # split  data into trainin
 from sklearn import preprocessing  # scale and center data
 from sklearn.svm import SVC  # this will make a support vector machine for classificaiton
 from sklearn.model_selection import GridSearchCV  # this will do cross validation
+from sklearn.experimental import enable_halving_search_cv  # noqa: F401, enables HalvingGridSearchCV
+from sklearn.model_selection import HalvingGridSearchCV  # successive halving drops weak candidates early
 from sklearn.metrics import ConfusionMatrixDisplay, accuracy_score  # creates and draws a confusion matrix
 from sklearn.decomposition import PCA  # to perform PCA to plot the data
-from joblib import dump
+from sklearn.model_selection import StratifiedKFold
+from sklearn.metrics import get_scorer
+from sklearn.metrics.pairwise import euclidean_distances
+import os
+from joblib import Parallel, delayed, dump, effective_n_jobs
+from time import perf_counter
+from analysis import feature_definition
+from classifier import STATE_NAMES, load_model
+from compact_model import CompactSVM
+from data_extraction import FEATURE_PARAMS
+from feature_store import FeatureSelection, FeatureStore
+from recorder import replace_file
 
 
-def svm_train():
+def _gram_fold(X, y, train, test, candidates, scoring):
+    # scores of every (C, gamma) candidate on one fold; the squared distances are computed once and every gamma's
+    # kernel is derived from them inline, then shared by all C values through kernel='precomputed'
+    scorer = get_scorer(scoring)
+    d_train = euclidean_distances(X[train], squared=True)
+    d_test = euclidean_distances(X[test], X[train], squared=True)
+    scores = {}
+    for gamma in dict.fromkeys(gamma for _, gamma in candidates):
+        k_train, k_test = np.exp(-gamma * d_train), np.exp(-gamma * d_test)
+        for C in dict.fromkeys(C for C, g in candidates if g == gamma):
+            clf = SVC(kernel='precomputed', C=C).fit(k_train, y[train])
+            scores[(C, gamma)] = scorer(clf, k_test, y[test])
+    return scores
+
+
+def gram_search(X, y, param_grid, scoring, cv=5, n_jobs=None, max_bytes=512 * 1024 * 1024):
+    """
+    Same selection as GridSearchCV(SVC(), param_grid, cv=cv, scoring=scoring) for RBF grids, but each fold's
+    squared distances are computed once and every gamma's kernel is shared by every C through
+    kernel='precomputed'. Folds run in parallel on n_jobs workers (-1 for all cores); each worker holds its
+    own fold's distance and kernel matrices, so only as many folds run at once as fit in max_bytes. When a
+    single fold does not fit, the search falls back to GridSearchCV, whose SVC computes the kernel on the fly.
+    """
+    X, y = np.asarray(X, dtype=np.float64), np.asarray(y)
+    folds = list(StratifiedKFold(n_splits=cv).split(X, y))
+    # float64 distances and kernel of the training rows against every row, see _gram_fold
+    fold_bytes = max(2 * 8 * len(train) * len(X) for train, _ in folds)
+    if fold_bytes > max_bytes:
+        search = GridSearchCV(SVC(), param_grid, cv=cv, scoring=scoring, n_jobs=n_jobs).fit(X, y)
+        return search.best_params_['C'], search.best_params_['gamma']
+    n_jobs = max(1, min(effective_n_jobs(n_jobs), max_bytes // fold_bytes))
+    # candidates in ParameterGrid order (C outer, gamma inner) so ties resolve like GridSearchCV
+    candidates = [(C, gamma) for grid in param_grid for C in grid['C'] for gamma in grid['gamma']]
+    fold_scores = Parallel(n_jobs=n_jobs)(delayed(_gram_fold)(X, y, train, test, candidates, scoring)
+                                          for train, test in folds)
+    mean_scores = [np.average([scores[candidate] for scores in fold_scores]) for candidate in candidates]
+    return candidates[int(np.argmax(mean_scores))]
+
+
+def svm_search(X, y, param_grid, scoring, search='grid', n_jobs=None):
+    # search='grid': exhaustive GridSearchCV, 'halving': successive halving, only the best candidates see all data,
+    # 'gram': exhaustive search sharing each fold's kernel matrices across C, same result as 'grid', folds in parallel
+    if search == 'gram':
+        return gram_search(X, y, param_grid, scoring, cv=5, n_jobs=n_jobs)
+    if search == 'halving':
+        optimal_params = HalvingGridSearchCV(SVC(), param_grid, cv=5, scoring=scoring, factor=3,
+                                             random_state=42, n_jobs=n_jobs, verbose=0)
+    else:
+        optimal_params = GridSearchCV(
+            SVC(),
+            param_grid,
+            cv=5,
+            scoring=scoring,  # NOTE: The default value for scoring results in worse performance...
+            # For more scoring metics see:
+            # https://scikit-learn.org/stable/modules/model_evaluation.html#scoring-parameter
+            n_jobs=n_jobs,  # -1 runs the candidates on every core
+            verbose=0  # If you want to see what Grid Search is doing, set verbose=2
+        )
+    optimal_params.fit(X, y)
+    return optimal_params.best_params_['C'], optimal_params.best_params_['gamma']
+
+
+def feature_columns(df):
+    # per-channel band powers of multi-channel recordings, see data_extraction.feature_names
+    return [c for c in df.columns if c not in ("state", "session", "subject", "timestamp")]
+
+
+class PhaseTimer(object):
+    # wall time of consecutive phases; done(phase) ends the current one, reports it to progress(phase, seconds)
+    # and starts the next
+    def __init__(self, progress=None):
+        self.progress = progress
+        self.timings = {}
+        self.t0 = perf_counter()
+
+    def done(self, phase):
+        self.timings[phase] = perf_counter() - self.t0
+        if self.progress is not None:
+            self.progress(phase, self.timings[phase])
+        self.t0 = perf_counter()
+
+    def __str__(self):
+        return ', '.join(f'{phase} {seconds:.2f}s' for phase, seconds in self.timings.items())
+
+
+def save_model(scaler, clf_svm, definition, path='./model/svm_model.joblib'):
+    # scaler, SVM and the feature definition they were fit on in one file replaced by a single rename, see
+    # classifier.load_model
+    replace_file(path, lambda file: dump({'scaler': scaler, 'svm': clf_svm, 'feature_definition': definition}, file))
+
+
+def export_compact(clf_svm, scaler, definition, rff_components=None, path='./model/svm_model.npz'):
+    # NumPy-only copy of the model for the online classifier, saved after the joblib model so it is the newer one
+    compact = CompactSVM.from_estimator(clf_svm, scaler, rff_components=rff_components,
+                                        feature_definition=definition)
+    compact.save(path)
+    return compact
+
+
+def svm_train(features=None, search='grid', n_jobs=None, diagnostics=True, progress=None, export=False,
+              rff_components=None):
+    """
+    Fits the scaler and RBF SVM and saves them to ./model, with the feature definition of the training data.
+
+    features: FeatureStore.select() rows or a labelled table from data_extraction.build_feature_table;
+    default is the whole ./data/features store, or the two *_cvt.txt files when there is no store yet
+    search: 'grid' for the exhaustive grid search, 'gram' for the same search sharing kernel matrices across C,
+    'halving' for successive halving
+    n_jobs: cores used by the search, -1 for all
+    diagnostics: also save the confusion matrix, scree plot and PCA decision surface to ./pic
+    progress: optional callable(phase, seconds) called as each phase finishes
+    export: also save ./model/svm_model.npz for the NumPy-only predictor in compact_model.CompactSVM
+    rff_components: export a random-Fourier-feature approximation of that many components instead of the
+    exact kernel expansion, worth it when there are thousands of support vectors
+    Fast recalibration: svm_train(features, search='halving', n_jobs=-1, diagnostics=False)
+    """
+    timer = PhaseTimer(progress)
     column_names = ["Delta", "Theta", "Alpha", "Beta", "Gamma"]
-    df0 = pd.read_csv("./data/state1_cvt.txt", header=None, names=column_names)
-    df0["state"] = 1
-    df1 = pd.read_csv("./data/state2_cvt.txt", header=None, names=column_names)
-    df1["state"] = 0
-    df = pd.concat([df0, df1], ignore_index=True)
-    X_encoded = df.drop('state', axis=1).copy()
-    y = df['state'].copy()
+    definition = feature_definition(FEATURE_PARAMS)  # the *_cvt.txt files are written with FEATURE_PARAMS
+    if features is None and FeatureStore().exists():
+        features = FeatureStore().select()
+    if isinstance(features, FeatureSelection):
+        # memory-mapped float32 rows, only the split below copies them
+        column_names = features.columns
+        X_encoded = features.X
+        y = features.y
+        definition = features.feature_definition or definition
+    elif features is None:
+        df0 = pd.read_csv("./data/state1_cvt.txt", header=None, names=column_names)
+        df0["state"] = 1
+        df1 = pd.read_csv("./data/state2_cvt.txt", header=None, names=column_names)
+        df1["state"] = 0
+        df = pd.concat([df0, df1], ignore_index=True)
+        X_encoded = df[column_names].copy()
+        y = df['state'].copy()
+    else:
+        df = features
+        column_names = feature_columns(df)
+        X_encoded = df[column_names].copy()
+        y = df['state'].copy()
+        definition = df.attrs.get('feature_definition', definition)
     X_train, X_test, y_train, y_test = train_test_split(X_encoded, y, random_state=42)
-    scaler = preprocessing.StandardScaler().fit(X_train)
-    dump(scaler, './model/scaler.joblib')
+    scaler = preprocessing.StandardScaler().fit(X_train)  # saved with the SVM once it is fit
     X_train_scaled = scaler.transform(X_train)
     X_test_scaled = scaler.transform(X_test)
+    timer.done('prepare')
 
     num_features = np.size(X_train_scaled, axis=1)
     param_grid = [
@@ -32,28 +177,84 @@ def svm_train():
          'gamma': [1 / num_features, 1, 0.1, 0.01, 0.001, 0.0001],
          'kernel': ['rbf']},
     ]
+    # ROC AUC needs probabilities for more than two classes, which SVC only gives with an extra internal CV
+    scoring = 'roc_auc' if len(np.unique(y_train)) == 2 else 'balanced_accuracy'
+    C, gamma = svm_search(X_train_scaled, y_train, param_grid, scoring, search=search, n_jobs=n_jobs)
+    timer.done('search')
 
-    optimal_params = GridSearchCV(
-        SVC(),
-        param_grid,
-        cv=5,
-        scoring='roc_auc',  # NOTE: The default value for scoring results in worse performance...
-        # For more scoring metics see:
-        # https://scikit-learn.org/stable/modules/model_evaluation.html#scoring-parameter
-        verbose=0  # If you want to see what Grid Search is doing, set verbose=2
-    )
-
-    optimal_params.fit(X_train_scaled, y_train)
-    C, gamma = optimal_params.best_params_['C'], optimal_params.best_params_['gamma']
     clf_svm = SVC(random_state=42, C=C, gamma=gamma)
     clf_svm.fit(X_train_scaled, y_train)
-    dump(clf_svm, './model/svm_model.joblib')  # save model
+    save_model(scaler, clf_svm, definition)  # save model
+    y_pred = clf_svm.predict(X_test_scaled)
+    accuracy = accuracy_score(y_test, y_pred)
+    timer.done('fit')
+
+    agreement = ''
+    if export:
+        compact = export_compact(clf_svm, scaler, definition, rff_components)
+        agreement = f", compact model agrees on {np.mean(compact.predict(X_test) == y_pred):.1%} of test windows"
+        timer.done('export')
+
+    if diagnostics:
+        svm_diagnostics(clf_svm, X_train_scaled, X_test_scaled, y_train, y_test, search=search, n_jobs=n_jobs)
+        timer.done('diagnostics')
+
+    return f"Complete training. Accuracy: {accuracy:.2f}{agreement} ({timer})"
+
+
+def svm_update(features, progress=None):
+    """
+    Folds newly labelled windows into the saved scaler and SVM without a search or a full refit.
+
+    The scaler's running mean / variance are updated with partial_fit. The old support vectors, mapped back
+    to raw band powers with the old scaler, carry everything the previous model learned; the SVM is refit
+    with its C and gamma on them plus the new windows. The fit set stays at support vectors + new windows,
+    so recalibration during a session takes tens of milliseconds. Run svm_train again for a new search.
+
+    features: labelled table of the new windows only, see data_extraction.build_feature_table(start=...),
+    extracted with the saved model's feature definition (load_model()['feature_definition'])
+    progress: optional callable(phase, seconds) called as each phase finishes
+    """
+    timer = PhaseTimer(progress)
+    saved = load_model()
+    scaler, clf_svm, definition = saved['scaler'], saved['svm'], saved['feature_definition']
+    if features.attrs.get('feature_definition', definition) != definition:
+        raise ValueError(f"features extracted with {features.attrs['feature_definition']}, the model was trained "
+                         f"on {definition}")
+    column_names = feature_columns(features)
+    X_new = features[column_names].to_numpy(dtype=np.float64)
+    y_new = features['state'].to_numpy()
+    if len(X_new) == 0:
+        return "No new windows to update the model with."
+    # how the current model does on data it has never seen, before it learns from it
+    accuracy = accuracy_score(y_new, clf_svm.predict(scaler.transform(X_new)))
+    X_support = scaler.inverse_transform(clf_svm.support_vectors_)
+    y_support = np.repeat(clf_svm.classes_, clf_svm.n_support_)  # support vectors are grouped by class
+    scaler.partial_fit(X_new)
+    timer.done('prepare')
+
+    n_support = len(X_support)
+    clf_svm = SVC(random_state=42, C=clf_svm.C, gamma=clf_svm.gamma)
+    clf_svm.fit(scaler.transform(np.concatenate((X_support, X_new))),
+                np.concatenate((y_support, y_new)))
+    save_model(scaler, clf_svm, definition)  # the classifier reloads
+    if os.path.exists('./model/svm_model.npz'):
+        # keep an exported compact model in step, with the same approximation it was exported with
+        rff_offsets = CompactSVM.load('./model/svm_model.npz').rff_offsets
+        export_compact(clf_svm, scaler, definition, None if rff_offsets is None else len(rff_offsets))
+    timer.done('fit')
+
+    return (f"Complete update. {len(X_new)} new windows, {n_support} support vectors. "
+            f"Accuracy on new windows before update: {accuracy:.2f} ({timer})")
+
+
+def svm_diagnostics(clf_svm, X_train_scaled, X_test_scaled, y_train, y_test, search='grid', n_jobs=None):
+    # confusion matrix, PCA scree plot and the decision surface of an SVM refit on the first two PCs
+    class_names = [STATE_NAMES.get(label, str(label)) for label in clf_svm.classes_]  # classes_ is sorted
     ConfusionMatrixDisplay.from_estimator(clf_svm,
                                           X_test_scaled,
                                           y_test,
-                                          display_labels=["Move", "Stop"])
-    y_pred = clf_svm.predict(X_test_scaled)
-    accuracy = accuracy_score(y_test, y_pred)
+                                          display_labels=class_names)
     plt.savefig("./pic/confusion_matrix.png")
     plt.clf()
 
@@ -86,18 +287,7 @@ def svm_train():
          'kernel': ['rbf']},
     ]
 
-    optimal_params = GridSearchCV(
-        SVC(),
-        param_grid,
-        cv=5,
-        scoring='accuracy',  # NOTE: The default value for scoring results in worse performance...
-        # For more scoring metics see:
-        # https://scikit-learn.org/stable/modules/model_evaluation.html#scoring-parameter
-        verbose=0  # NOTE: If you want to see what Grid Search is doing, set verbose=2
-    )
-
-    optimal_params.fit(pca_train_scaled, y_train)
-    C, gamma = optimal_params.best_params_['C'], optimal_params.best_params_['gamma']
+    C, gamma = svm_search(pca_train_scaled, y_train, param_grid, 'accuracy', search=search, n_jobs=n_jobs)
     clf_svm = SVC(random_state=42, C=C, gamma=gamma)
     clf_svm.fit(pca_train_scaled, y_train)
 
@@ -122,7 +312,7 @@ def svm_train():
     ax.contourf(xx, yy, Z, alpha=0.1)
 
     # now create custom colors for the actual data points
-    cmap = colors.ListedColormap(['#e41a1c', '#4daf4a'])
+    cmap = colors.ListedColormap(['#e41a1c', '#4daf4a', '#377eb8', '#984ea3', '#ff7f00'][:len(class_names)])
 
     scatter = ax.scatter(test_pc1_coords, test_pc2_coords, c=y_test,
                          cmap=cmap,
@@ -134,8 +324,8 @@ def svm_train():
     legend = ax.legend(scatter.legend_elements()[0],
                        scatter.legend_elements()[1],
                        loc="upper right")
-    legend.get_texts()[0].set_text("Move")
-    legend.get_texts()[1].set_text("Stop")
+    for text, name in zip(legend.get_texts(), class_names):
+        text.set_text(name)
 
     # now add axis labels and titles
     ax.set_ylabel('PC2')
@@ -143,5 +333,3 @@ def svm_train():
     ax.set_title('Decison surface using the PCA transformed/projected features')
     plt.savefig('./pic/svm.png')
 
-    return f"Complete training. Accuracy: {accuracy:.2f}"
-
@@ -1,95 +1,141 @@
-from collections import deque
 import socket
-import json
 import threading
-from time import sleep
+from time import perf_counter
 
-import select
-import queue
+import numpy as np
+
+from metrics import Metrics
+from stream_decoder import FrameDecoder, decode_block
 
 
 class TCPClient(object):
-    def __init__(self):
-        self.tcpIp = '127.0.0.1'
-        self.tcpPort = 5555
+    """
+    Blocking OpenSignals client: a receive thread connects (retrying while OpenSignals is down), then sleeps in
+    recv() until data arrives (with a short timeout so it can notice stop()), and commands are sent directly from
+    the caller's thread, so nothing spins while idle and stop() works even before the first connection.
+    """
+
+    def __init__(self, d, tcp_ip='127.0.0.1', tcp_port=5555, timeout=0.5, m=None):
+        self.tcpIp = tcp_ip
+        self.tcpPort = tcp_port
         self.buffer_size = 99999
+        self.timeout = timeout  # seconds recv() may block before rechecking isChecking
 
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.inputCheck = []
-        self.outputCheck = []
+        self.d = d  # shared ring buffer
+        self.socket = None
+        self.sendLock = threading.Lock()
         self.isChecking = False
+        self.stopping = threading.Event()  # wakes connect() from its backoff sleep
         self.isAcquiring = False
-        self.msgQueue = queue.Queue()
-        self.myDeque = deque([0]*10000, maxlen=10000)  # length of queue, record 10s datas (fs = 1000Hz)
-        # when 'maxlen' is decided, deque can put and pop items automatically
-
-    def connect(self):
-        self.socket.connect((self.tcpIp, self.tcpPort))
-        self.outputCheck.append(self.socket)
+        self.decoder = FrameDecoder()
+        self.thread = None
+        self.metrics = Metrics('acquisition')
+        self.m = m  # queue the metrics snapshots are published to
+
+    def connect(self, backoff=0.5, backoff_max=8.0):
+        # retry with exponential backoff until OpenSignals accepts the connection or stop() is called
+        delay = backoff
+        while self.isChecking:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect((self.tcpIp, self.tcpPort))
+            except OSError:
+                sock.close()
+                self.stopping.wait(delay)
+                delay = min(delay * 2, backoff_max)
+                continue
+            self.socket = sock
+            self.decoder.reset()
+            if self.isAcquiring:
+                self.send('start')  # a start sent while disconnected, or acquisition running before a drop
+            return True
+        return False
+
+    def start(self):
         self.isChecking = True
-
-    def start(self, d):
-        thread = threading.Thread(target=self.msg_checker, args=(d,))
-        thread.daemon = True
-        thread.start()
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.msg_checker)
+        self.thread.daemon = True
+        self.thread.start()
 
     def stop(self):
         self.isChecking = False
-        self.socket.close()
-
-    def msg_checker(self, d):
+        self.stopping.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        if self.socket is not None:
+            self.socket.close()
+
+    def msg_checker(self):
+        if not self.connect():
+            return
+        last_recv = perf_counter()
         while self.isChecking:
-            readable, writable, exceptional = select.select(self.inputCheck, self.outputCheck, self.inputCheck)
-            for s in readable:
-                message = s.recv(self.buffer_size)
-                if not self.isAcquiring:
-                    self.inputCheck = []
-                else:
-                    message = json.loads(message)
-                    message = message["returnData"]
-                    for device in message.keys():
-                        for data_list in message[device]:
-                            number = data_list[-1]  # this is the data we collected
-                            self.myDeque.append(number)
-                            d[:] = self.myDeque  # add datas to the shared queue
-                            # print(number)  # Print the number
-
-            for _ in writable:
+            self.metrics.publish(self.m)
+            try:
+                message = self.socket.recv(self.buffer_size)
+            except socket.timeout:
+                continue
+            except OSError:
+                message = b''
+            t_recv = perf_counter()
+            if not message:
+                # connection dropped, acquisition resumes once OpenSignals is back
+                self.metrics.inc('reconnects')
+                self.socket.close()
+                if not self.connect():
+                    break
+                continue
+            # recv: time between consecutive arrivals, parse: JSON reassembly and decoding, commit: buffer write
+            self.metrics.observe('recv', t_recv - last_recv)
+            last_recv = t_recv
+            self.metrics.inc('bytes_received', len(message))
+            if not self.isAcquiring:
+                self.decoder.reset()
+                continue
+            decode_errors = self.decoder.decode_errors
+            blocks = []
+            for frame in self.decoder.feed(message):
+                try:
+                    blocks.append(decode_block(frame, self.d.channels))
+                except (ValueError, TypeError):
+                    self.decoder.decode_errors += 1  # malformed samples, only this frame is dropped
+            t_parsed = perf_counter()
+            self.metrics.observe('parse', t_parsed - t_recv)
+            if self.decoder.decode_errors > decode_errors:
+                self.metrics.inc('decode_errors', self.decoder.decode_errors - decode_errors)  # dropped text
+            if blocks:
+                block = np.concatenate(blocks)
                 try:
-                    next_msg = self.msgQueue.get_nowait()
-                except queue.Empty:
-                    pass
-                else:
-                    self.socket.send(str(next_msg).encode())
-
-            for s in exceptional:
-                print("exceptional ", s)
-
-    def add_msg_to_send(self, data):
-        self.msgQueue.put(data)
-        if self.socket not in self.outputCheck:
-            self.outputCheck.append(self.socket)
-        if self.socket not in self.inputCheck:
-            self.inputCheck.append(self.socket)
+                    self.d.extend(block)  # one bulk write per recv to the shared ring buffer
+                except ValueError:
+                    self.metrics.inc('decode_errors')  # never let one bad block end the receive thread
+                    continue
+                self.metrics.observe('commit', perf_counter() - t_parsed)
+                self.metrics.inc('frames', len(blocks))
+                self.metrics.inc('samples_ingested', len(block))
+
+    def send(self, data):
+        if not data:
+            return
+        with self.sendLock:
+            if self.socket is None:
+                return  # not connected yet, connect() sends 'start' if acquisition was requested meanwhile
+            try:
+                self.socket.sendall(str(data).encode())
+            except OSError:
+                pass  # the receive thread reconnects
 
     def set_is_acquiring(self, is_acquiring):
         self.isAcquiring = is_acquiring
 
 
-def tcp_client_processing(d, q):
-    CONNECTION = TCPClient()
-    connect_flag = False
-    while not connect_flag:
-        try:
-            CONNECTION.connect()
-            connect_flag = True
-        except ConnectionRefusedError:
-            sleep(3)
-
-    CONNECTION.start(d)
+def tcp_client_processing(d, q, tcp_ip='127.0.0.1', tcp_port=5555, m=None):
+    CONNECTION = TCPClient(d, tcp_ip, tcp_port, m=m)
+    CONNECTION.start()  # connects in the receive thread, commands (exit included) are read meanwhile
     while True:
-
-        user_action = str(q.get())  # get input from dash app
+        user_action = str(q.get())  # blocks until the dash app sends a command
         if user_action == '0':
             CONNECTION.set_is_acquiring(True)
         elif user_action == '1':
@@ -98,7 +144,7 @@ def tcp_client_processing(d, q):
             CONNECTION.stop()
             break
         new_msg = action_decode(user_action)
-        CONNECTION.add_msg_to_send(new_msg)  # send actions to opensignals app
+        CONNECTION.send(new_msg)  # send actions to opensignals app
 
 
 def action_decode(action):
@@ -0,0 +1,178 @@
+import json
+import queue
+import signal
+import sys
+import threading
+import traceback
+from itertools import count
+from multiprocessing import Process, Queue
+from queue import Empty
+from time import perf_counter
+
+
+# end sample of the last window of every recording the saved model was trained on, mode='update' extracts the
+# windows from there on
+TRAINED_ON_PATH = './model/trained_on.json'
+
+
+def _trained_on():
+    try:
+        with open(TRAINED_ON_PATH, 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def _run_process_job(messages, recordings, cache_dir, store_dir, mode, train_kwargs):
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(1))  # cancel: let the feature pool shut down cleanly
+    _run_job(messages, recordings, cache_dir, store_dir, mode, train_kwargs)
+
+
+def _run_job(messages, recordings, cache_dir, store_dir, mode, train_kwargs):
+    # runs in the job process (or thread), every step is reported back through the messages queue
+    try:
+        from classifier import load_model
+        from data_extraction import build_feature_table
+        from feature_cache import FeatureCache
+        from feature_store import FeatureStore
+        from recorder import replace_file
+        from svm_training import svm_train, svm_update
+
+        messages.put(('phase', 'features', None))
+        t0 = perf_counter()
+        if mode == 'update':
+            # only the samples recorded since the model was saved, too few to be worth the pool or the cache,
+            # extracted the way the model's features were
+            trained_on = _trained_on()
+            recordings = [dict(r, start=trained_on[r['path']]) if r['path'] in trained_on else r
+                          for r in recordings]
+            features = build_feature_table(recordings, processes=1, **load_model()['feature_definition'])
+        else:
+            cache = FeatureCache(cache_dir) if cache_dir else None
+            features = build_feature_table(recordings, cache=cache)
+        covered = features.attrs['covered']
+        messages.put(('timing', 'features', perf_counter() - t0))
+
+        def progress(phase, seconds):
+            messages.put(('timing', phase, seconds))
+
+        # the store always holds what the saved model was trained on: full jobs replace it and train from its
+        # memory map, updates append their windows once the model has taken them
+        store = FeatureStore(store_dir)
+        if mode == 'update':
+            messages.put(('phase', 'training', None))
+            result = svm_update(features, progress=progress)
+            t0 = perf_counter()
+            if store.exists():
+                store.append(features)
+            messages.put(('timing', 'store', perf_counter() - t0))
+        else:
+            t0 = perf_counter()
+            store.write(features)
+            messages.put(('timing', 'store', perf_counter() - t0))
+            messages.put(('phase', 'training', None))
+            result = svm_train(store.select(), progress=progress, **train_kwargs)
+        trained_on = json.dumps(dict(_trained_on(), **covered)).encode()
+        replace_file(TRAINED_ON_PATH, lambda file: file.write(trained_on))
+        messages.put(('done', result, None))
+    except Exception:
+        messages.put(('error', traceback.format_exc(limit=3), None))
+
+
+class TrainingJob(object):
+    def __init__(self, job_id, process, messages):
+        self.job_id = job_id
+        self.process = process
+        self.messages = messages
+        self.status = 'running'
+        self.phase = 'starting'
+        self.timings = {}
+        self.result = None
+        self.error = None
+
+    def update(self):
+        alive = self.process.is_alive()  # checked first, a finished process has flushed all its messages
+        try:
+            while True:
+                kind, value, seconds = self.messages.get_nowait()
+                if kind == 'phase':
+                    self.phase = value
+                elif kind == 'timing':
+                    self.timings[value] = seconds
+                elif kind == 'done':
+                    self.status, self.result = 'done', value
+                elif kind == 'error':
+                    self.status, self.error = 'failed', value
+        except Empty:
+            pass
+        if self.status == 'running' and not alive:
+            exitcode = getattr(self.process, 'exitcode', None)
+            self.status, self.error = 'failed', f'training process exited with code {exitcode}'
+        if self.status != 'running':
+            self.process.join(timeout=0)
+
+    def describe(self):
+        phases = ', '.join(f'{phase} {seconds:.2f}s' for phase, seconds in self.timings.items())
+        if self.status == 'done':
+            return self.result
+        if self.status == 'cancelled':
+            return 'Training cancelled.'
+        if self.status == 'failed':
+            return f'Training failed: {self.error}'
+        return f'Training ({self.phase}) {phases}'.rstrip()
+
+
+class TrainingJobRunner(object):
+    """
+    Runs feature extraction and svm_train in a separate process so the Dash server and acquisition stay live.
+
+    submit(recordings, mode='full') runs the complete search and fit. mode='update' folds only the samples
+    recorded since the last job into the saved model with svm_update; that takes milliseconds, less than
+    starting a process and importing scikit-learn in it, so it runs in a thread of this process instead.
+    submit() returns a job id; poll() reports status ('running', 'done', 'failed', 'cancelled'), the current
+    phase and per-phase timings; cancel() terminates a running full job. Only one job runs at a time.
+    Full jobs write their features to the FeatureStore in store_dir and train from it, updates append to it.
+    """
+
+    def __init__(self, cache_dir='./cache/features', store_dir='./data/features'):
+        self.cache_dir = cache_dir
+        self.store_dir = store_dir
+        self.jobs = {}
+        self.ids = count(1)
+
+    def active(self):
+        for job in self.jobs.values():
+            job.update()
+            if job.status == 'running':
+                return job
+        return None
+
+    def submit(self, recordings, mode='full', **train_kwargs):
+        job = self.active()
+        if job is not None:
+            return job.job_id
+        args = (list(recordings), self.cache_dir, self.store_dir, mode, train_kwargs)
+        if mode == 'update':
+            messages = queue.Queue()
+            process = threading.Thread(target=_run_job, args=(messages,) + args, daemon=True)
+        else:
+            messages = Queue()
+            process = Process(target=_run_process_job, args=(messages,) + args)
+        process.start()
+        job = TrainingJob(next(self.ids), process, messages)
+        self.jobs[job.job_id] = job
+        return job.job_id
+
+    def poll(self, job_id):
+        job = self.jobs[job_id]
+        job.update()
+        return job
+
+    def cancel(self, job_id):
+        job = self.jobs[job_id]
+        job.update()
+        if job.status == 'running' and isinstance(job.process, Process):  # updates finish on their own
+            job.process.terminate()
+            job.process.join()
+            job.status = 'cancelled'
+        return job